@@ -0,0 +1,80 @@
+import itertools
+import random
+import threading
+import time
+
+import slack
+
+
+class FakeResponse(dict):
+    """Just enough of slack.web.slack_response.SlackResponse for the bot and for SlackApiError"""
+
+    def __init__(self, data, status_code=200, headers=None):
+        super().__init__(data)
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+class FakeWebClient:
+    """In-process stand-in for slack.WebClient.
+
+    Records every call, sleeps `latency` seconds per call and answers a `rate_limit_ratio` fraction of the calls
+    with a 429 ratelimited error."""
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.calls = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(**kwargs):
+            with self._lock:
+                self.calls.append((method, kwargs))
+                rate_limited = self._random.random() < self.rate_limit_ratio
+            if self.latency:
+                time.sleep(self.latency)
+            if rate_limited:
+                response = FakeResponse({'ok': False, 'error': 'ratelimited'},
+                                        status_code=429, headers={'Retry-After': str(self.retry_after)})
+                raise slack.errors.SlackApiError('ratelimited', response)
+            return FakeResponse(self._answer(method, kwargs))
+
+        return call
+
+    def _answer(self, method, kwargs):
+        if method == 'chat_getPermalink':
+            return {'ok': True, 'permalink': f"https://example.slack.com/archives/{kwargs['channel']}/p1"}
+        if method == 'users_info':
+            user_id = kwargs['user']
+            return {'ok': True, 'user': {'id': user_id, 'name': f'user{user_id}', 'real_name': f'User {user_id}'}}
+        if method == 'team_info':
+            return {'ok': True, 'team': {'id': 'T0', 'name': 'benchmark'}}
+        if method == 'conversations_info':
+            channel_id = kwargs['channel']
+            return {'ok': True, 'channel': {'id': channel_id, 'is_channel': True, 'is_private': False,
+                                            'name': channel_id.lower(), 'name_normalized': channel_id.lower()}}
+        if method == 'conversations_members':
+            return {'ok': True, 'members': ['U1', 'U2'], 'response_metadata': {'next_cursor': ''}}
+        if method in ('users_list', 'conversations_list'):
+            return {'ok': True, 'members': [], 'channels': [], 'response_metadata': {'next_cursor': ''}}
+        return {'ok': True, 'ts': f'{next(self._ids)}.000'}
+
+    def calls_by_method(self):
+        with self._lock:
+            methods = [method for method, _ in self.calls]
+        return {method: methods.count(method) for method in sorted(set(methods))}
+
+
+class FakeRTMClient:
+    """Only used as the key that maps RTM callbacks to their tenant"""
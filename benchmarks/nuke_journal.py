@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Compare the nuke thread undo journal with the YAML state_file it replaces
+
+Usage:
+    python -m benchmarks.nuke_journal [--threads 5000] [--lookups 500]
+
+Both start with --threads nuked threads of 1 to 200 removed comments each, in a temporary data directory. The
+report has the file size, the mean time to look up the comments of one thread (what `nuke thread_undo` does
+before approving them) and the mean time to record one more nuke."""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def nukes(threads):
+    rnd = random.Random(1)
+    for i in range(threads):
+        thread_id = f'{rnd.randrange(36 ** 6):x}'
+        yield thread_id, [f'{rnd.randrange(36 ** 7):x}' for _ in range(rnd.randrange(1, 200))]
+
+
+def time_calls(call, thread_ids, lookups):
+    rnd = random.Random(2)
+    durations = []
+    for _ in range(lookups):
+        thread_id = rnd.choice(thread_ids)
+        started = time.perf_counter()
+        call(thread_id)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def summary(name, threads, path, lookups, records):
+    return {
+        'storage': name,
+        'threads': threads,
+        'file_bytes': os.path.getsize(path),
+        'lookup_mean_ms': round(statistics.fmean(lookups) * 1000, 3),
+        'lookup_p99_ms': round(sorted(lookups)[int(0.99 * len(lookups))] * 1000, 3),
+        'record_mean_ms': round(statistics.fmean(records) * 1000, 3)}
+
+
+def run(args):
+    import state_file as state_file_module
+    from commands.reddit.nuke_journal import NukeJournal
+
+    all_nukes = list(nukes(args.threads))
+    thread_ids = [thread_id for thread_id, _ in all_nukes]
+    results = []
+    with tempfile.TemporaryDirectory() as data_directory:
+        state_file_module.DATA_DIRECTORY = data_directory
+        os.environ['LOG_NAME'] = 'benchmark'
+        os.environ['STATE_BACKEND'] = 'yaml'
+        with state_file_module.state_file('nuke_thread') as state:
+            state.update(all_nukes)
+
+        def yaml_lookup(thread_id):
+            with state_file_module.state_file('nuke_thread') as state:
+                return state.get(thread_id)
+
+        def yaml_record(thread_id):
+            with state_file_module.state_file('nuke_thread') as state:
+                state[thread_id + 'x'] = ['abc1234']
+
+        lookups = time_calls(yaml_lookup, thread_ids, args.lookups)
+        records = time_calls(yaml_record, thread_ids, max(1, args.lookups // 10))
+        results.append(summary('yaml', args.threads, os.path.join(data_directory, 'nuke_thread-benchmark.yml'),
+                               lookups, records))
+
+        journal = NukeJournal(os.path.join(data_directory, 'nuke_journal-benchmark.log'))
+        for thread_id, comment_ids in all_nukes:
+            journal.record(thread_id, comment_ids)
+        lookups = time_calls(journal.lookup, thread_ids, args.lookups)
+        records = time_calls(lambda thread_id: journal.record(thread_id + 'x', ['abc1234']), thread_ids,
+                             max(1, args.lookups // 10))
+        results.append(summary('journal', args.threads, journal.path, lookups, records))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=500)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
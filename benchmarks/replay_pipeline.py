@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Replay RTM message payloads through handle_message -> parse_shortcuts -> handle_line -> commands.gyrobot
+
+Usage:
+    python -m benchmarks.replay_pipeline [--messages messages.jsonl] [--synthetic 1000] [--latency 0.01] ...
+
+Each line of the JSONL file is the `data` of an RTM `message` event. Without a file, a synthetic mix of chatter and
+cheap commands (no network access needed) is generated."""
+import argparse
+import collections
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+from benchmarks.fake_slack import FakeWebClient, FakeRTMClient
+
+SYNTHETIC_COMMANDS = ['cointoss', 'roll', 'roll 2d20+3 1d6 3d8', 'roll magic8', 'binary 01101000 01101001', 'help']
+
+
+def synthetic_messages(count, bot_name, command_ratio, seed):
+    rnd = random.Random(seed)
+    for i in range(count):
+        channel = f'C{rnd.randrange(8)}'
+        if rnd.random() < command_ratio:
+            text = f'{bot_name} {rnd.choice(SYNTHETIC_COMMANDS)}'
+        else:
+            text = ' '.join(rnd.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for _ in range(8))
+        yield {'type': 'message', 'channel': channel, 'user': f'U{rnd.randrange(50)}', 'team': 'T0',
+               'text': text, 'ts': f'{1600000000 + i}.000100', 'client_msg_id': f'synthetic-{i}'}
+
+
+def load_messages(path):
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def wait_until_idle(slack_bot, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = slack_bot.dispatcher.stats()
+        if stats['active_channels'] == 0 and stats['busy_workers'] == 0:
+            return
+        time.sleep(0.005)
+    raise TimeoutError('Pipeline did not drain')
+
+
+def wait_until_sent(slack_bot, timeout=600):
+    for tenant in slack_bot.tenants:
+        if tenant.outbound is not None and not tenant.outbound.join(timeout=timeout):
+            raise TimeoutError('Outbound queue did not drain')
+
+
+def run(args):
+    os.environ.setdefault('LOCALE', 'C')
+    os.environ['DISPATCHER_WORKERS'] = str(args.workers)
+    import slack_bot
+
+    tenant_config = {'BOT_NAME': args.bot_name, 'SLACK_API_TOKEN': 'xoxb-benchmark', 'LOG_NAME': 'benchmark'}
+    if args.shortcuts:
+        tenant_config['SHORTCUT_WORDS'] = args.shortcuts
+    if args.coalesce:
+        tenant_config['COALESCE_MESSAGES'] = '1'
+    if args.send_inline:
+        tenant_config['SLACK_SEND_INLINE'] = '1'
+    slack_bot.logger = slack_bot.get_logger('benchmark')
+    slack_bot.init([tenant_config])
+    tenant = slack_bot.tenants[0]
+    rtm_client = FakeRTMClient()
+    slack_bot.tenants_by_client[rtm_client] = tenant
+    web_client = FakeWebClient(latency=args.latency, rate_limit_ratio=args.rate_limit_ratio, seed=args.seed)
+
+    # time each dispatched message from the moment it arrived until its last command returned,
+    # and every other message until handle_message returned
+    arrived = {}
+    dispatched = set()
+    latencies = []
+    handle_lines = slack_bot.dispatcher.handler
+    submit = slack_bot.dispatcher.submit
+
+    def timed_handle_lines(tenant_, chat, text_lines):
+        handle_lines(tenant_, chat, text_lines)
+        latencies.append(time.perf_counter() - arrived[chat.message['ts']])
+
+    def tracking_submit(key, tenant_, chat, text_lines):
+        dispatched.add(chat.message['ts'])
+        submit(key, tenant_, chat, text_lines)
+
+    slack_bot.dispatcher.handler = timed_handle_lines
+    slack_bot.dispatcher.submit = tracking_submit
+
+    # what slackbot_events_total counts, so that commands failing fast don't pass for a fast pipeline
+    events = collections.Counter()
+    count = tenant.count
+
+    def counting(event):
+        events[event] += 1
+        count(event)
+
+    tenant.count = counting
+
+    if args.messages:
+        messages = list(load_messages(args.messages))
+    else:
+        messages = list(synthetic_messages(args.synthetic, args.bot_name, args.command_ratio, args.seed))
+
+    started = time.perf_counter()
+    for msg in messages:
+        arrived[msg['ts']] = message_started = time.perf_counter()
+        slack_bot.handle_message(data=dict(msg), web_client=web_client, rtm_client=rtm_client)
+        if msg['ts'] not in dispatched:
+            latencies.append(time.perf_counter() - message_started)
+    wait_until_idle(slack_bot)
+    elapsed = time.perf_counter() - started
+    # with the outbound queue, replies keep going out (within the rate limits) after the commands are done
+    wait_until_sent(slack_bot)
+    delivered = time.perf_counter() - started
+    slack_bot.dispatcher.shutdown()
+
+    total_calls = len(web_client.calls)
+    report = {
+        'messages': len(messages),
+        'seconds': round(elapsed, 3),
+        'seconds_until_replies_sent': round(delivered, 3),
+        'messages_per_second': round(len(messages) / elapsed, 1) if elapsed else None,
+        'commands': events['commands'],
+        'errors': events['errors'],
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'latency_mean_ms': round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        'api_calls': total_calls,
+        'api_calls_per_message': round(total_calls / len(messages), 3) if messages else 0.0,
+        'api_calls_by_method': web_client.calls_by_method(),
+        'api_calls_skipped': dict(tenant.chat.api_calls_skipped),
+    }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', help='JSONL file with recorded RTM message payloads')
+    parser.add_argument('--synthetic', type=int, default=1000, help='number of synthetic messages without a file')
+    parser.add_argument('--command-ratio', type=float, default=0.2, help='share of synthetic messages that are commands')
+    parser.add_argument('--bot-name', default='gyrobot')
+    parser.add_argument('--shortcuts', help='shortcuts file name, relative to data/')
+    parser.add_argument('--coalesce', action='store_true', help='join the messages of a command (COALESCE_MESSAGES)')
+    parser.add_argument('--send-inline', action='store_true', help='send replies without the outbound queue')
+    parser.add_argument('--workers', type=int, default=4, help='DISPATCHER_WORKERS, 0 runs commands inline')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Slack API call')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of Slack API calls answered 429')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    report = run(args)
+    # the bot routes sys.stdout through its capture sinks, print the report to the real one
+    print(json.dumps(report, indent=2), file=sys.__stdout__)
+    if report['errors']:
+        print(f"{report['errors']} of {report['commands']} commands failed, the timings are not meaningful",
+              file=sys.__stderr__)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Compare the YAML and SQLite backends of state_file
+
+Usage:
+    python -m benchmarks.state_backends [--keys 5000] [--operations 500]
+
+Both backends start from the same data (--keys entries shaped like the nuke_thread state) in a temporary data
+directory. The report has the mean time of a state_file block that reads one key, and of one that writes one key."""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def populate(state_file, keys):
+    rnd = random.Random(1)
+    with state_file('benchmark') as state:
+        for i in range(keys):
+            state[f'thread{i}'] = [f'{rnd.randrange(36 ** 7):x}' for _ in range(rnd.randrange(1, 40))]
+
+
+def time_blocks(state_file, operations, keys, write):
+    rnd = random.Random(2)
+    durations = []
+    for i in range(operations):
+        key = f'thread{rnd.randrange(keys)}'
+        started = time.perf_counter()
+        with state_file('benchmark') as state:
+            if write:
+                state[key] = [f'{i:x}']
+            else:
+                state.get(key)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def run(args):
+    import state_file as state_file_module
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_directory:
+        state_file_module.DATA_DIRECTORY = data_directory
+        os.environ['LOG_NAME'] = 'benchmark'
+        for backend in ('yaml', 'sqlite'):
+            os.environ['STATE_BACKEND'] = backend
+            populate(state_file_module.state_file, args.keys)
+            reads = time_blocks(state_file_module.state_file, args.operations, args.keys, write=False)
+            writes = time_blocks(state_file_module.state_file, args.operations, args.keys, write=True)
+            sizes = [os.path.getsize(os.path.join(data_directory, name)) for name in os.listdir(data_directory)
+                     if ('.yml' if backend == 'yaml' else '.sqlite3') in name]
+            results.append({
+                'backend': backend,
+                'keys': args.keys,
+                'read_block_mean_ms': round(statistics.fmean(reads) * 1000, 3),
+                'read_block_p99_ms': round(sorted(reads)[int(0.99 * len(reads))] * 1000, 3),
+                'write_block_mean_ms': round(statistics.fmean(writes) * 1000, 3),
+                'write_block_p99_ms': round(sorted(writes)[int(0.99 * len(writes))] * 1000, 3),
+                'file_bytes': sum(sizes)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=5000)
+    parser.add_argument('--operations', type=int, default=500)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Compare the Events API ingestion of web.py with the Flask handler it replaced
+
+Usage:
+    python -m benchmarks.web_ingestion [--events 2000] [--concurrency 50] [--kick-latency 0.2] [--kick-ratio 0.5]
+
+Both servers listen on localhost and call a fake Slack API (also on localhost) that answers conversations.kick
+after --kick-latency seconds. The report has the acknowledgement latency seen by Slack, acknowledged events per
+second and, for web.py, how long the workers needed to finish the queued kicks."""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import socket
+import statistics
+import threading
+import time
+
+import aiohttp
+import requests
+from aiohttp import web as aiohttp_web
+from flask import Flask, request, abort, make_response
+from werkzeug.serving import make_server
+
+TEAM = 'T0'
+PROTECTED_CHANNEL = 'C1'
+ALLOWED_USER = 'U0'
+SIGNING_SECRET = 'benchmark-secret'
+
+
+def legacy_app(protected_channels, api_url, token):
+    """The Flask handler of web.py before it moved to aiohttp, with a configurable Slack API URL"""
+    app = Flask(__name__)
+
+    @app.route('/event', methods=('GET', 'POST'))
+    def event():
+        if not request.json:
+            abort(400)
+
+        call_type = request.json['type']
+        if call_type == 'url_verification':
+            challenge = request.json['challenge']
+            return challenge
+        elif call_type == 'event_callback':
+            the_event = request.json['event']
+            event_type = the_event['type']
+            if event_type == 'member_joined_channel':
+                the_team = the_event['team']
+                the_channel = the_event['channel']
+                the_user = the_event['user']
+                if the_team in protected_channels and the_channel in protected_channels[the_team] and the_user not in protected_channels[the_team][the_channel]:
+                    resp = requests.post(
+                        api_url + 'conversations.kick',
+                        json={
+                            'channel': the_channel,
+                            'user': the_user},
+                        headers={
+                            'Content-type': 'application/json',
+                            'Authorization': 'Bearer ' + token})
+                    assert resp.ok
+                    return make_response('', 200)
+        # the original fell through here, which Flask answers with a 500
+        return make_response('', 200)
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def make_payloads(count, kick_ratio):
+    for i in range(count):
+        kicked = i < count * kick_ratio
+        the_event = {'type': 'member_joined_channel', 'team': TEAM,
+                     'channel': PROTECTED_CHANNEL if kicked else 'C2', 'user': f'U{i + 1}'}
+        yield json.dumps({'type': 'event_callback', 'event_id': f'Ev{i}', 'event': the_event}).encode()
+
+
+def signed_headers(body):
+    timestamp = str(int(time.time()))
+    signature = hmac.new(SIGNING_SECRET.encode(), b'v0:' + timestamp.encode() + b':' + body, hashlib.sha256)
+    return {'Content-Type': 'application/json', 'X-Slack-Request-Timestamp': timestamp,
+            'X-Slack-Signature': 'v0=' + signature.hexdigest()}
+
+
+class FakeSlackApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.kicks = 0
+        self.app = aiohttp_web.Application()
+        self.app.router.add_post('/api/conversations.kick', self.kick)
+
+    async def kick(self, request):
+        await request.read()
+        await asyncio.sleep(self.latency)
+        self.kicks += 1
+        return aiohttp_web.json_response({'ok': True})
+
+
+async def serve(app, port):
+    runner = aiohttp_web.AppRunner(app)
+    await runner.setup()
+    await aiohttp_web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+async def send_events(url, payloads, concurrency):
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def send(body):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, data=body, headers=signed_headers(body)) as resp:
+                    await resp.read()
+                latencies.append(time.perf_counter() - started)
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(body) for body in payloads))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies, statuses
+
+
+def report(name, count, elapsed, latencies, statuses, **extra):
+    return {'server': name, 'events': count, 'seconds': round(elapsed, 3),
+            'acks_per_second': round(count / elapsed, 1) if elapsed else None,
+            'ack_p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'ack_p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'ack_mean_ms': round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+            'statuses': statuses, **extra}
+
+
+async def run(args):
+    import web
+
+    protected_channels = {TEAM: {PROTECTED_CHANNEL: [ALLOWED_USER]}}
+    payloads = list(make_payloads(args.events, args.kick_ratio)) * args.duplicates
+    fake_api = FakeSlackApi(args.kick_latency)
+    api_port = free_port()
+    api_runner = await serve(fake_api.app, api_port)
+    api_url = f'http://127.0.0.1:{api_port}/api/'
+    results = []
+
+    # the old Flask app, on werkzeug's threaded server like app.run()
+    legacy_port = free_port()
+    legacy_server = make_server('127.0.0.1', legacy_port, legacy_app(protected_channels, api_url, 'xoxb-benchmark'),
+                                threaded=True)
+    threading.Thread(target=legacy_server.serve_forever, daemon=True).start()
+    elapsed, latencies, statuses = await send_events(
+        f'http://127.0.0.1:{legacy_port}/event', payloads, args.concurrency)
+    legacy_server.shutdown()
+    results.append(report('flask', len(payloads), elapsed, latencies, statuses, kicks=fake_api.kicks))
+
+    fake_api.kicks = 0
+    web.SLACK_API_URL = api_url
+    app = web.make_app(signing_secret=SIGNING_SECRET, token='xoxb-benchmark',
+                       protected_channels=protected_channels, workers=args.workers,
+                       kicks_per_minute=args.kicks_per_minute)
+    port = free_port()
+    runner = await serve(app, port)
+    started = time.perf_counter()
+    elapsed, latencies, statuses = await send_events(f'http://127.0.0.1:{port}/event', payloads, args.concurrency)
+    await app['events'].join()
+    await app['kicker'].queue.join()
+    processed = time.perf_counter() - started
+    await runner.cleanup()
+    results.append(report('aiohttp', len(payloads), elapsed, latencies, statuses, kicks=fake_api.kicks,
+                          seconds_until_processed=round(processed, 3),
+                          kicks_per_second=round(fake_api.kicks / processed, 1) if processed else None))
+
+    await api_runner.cleanup()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight at the same time')
+    parser.add_argument('--kick-latency', type=float, default=0.2, help='seconds the fake conversations.kick takes')
+    parser.add_argument('--kick-ratio', type=float, default=0.5, help='share of joins into the protected channel')
+    parser.add_argument('--kicks-per-minute', type=int, default=60000,
+                        help='web.py kick rate limit (KICKS_PER_MINUTE), Slack allows about 50')
+    parser.add_argument('--duplicates', type=int, default=1, help='times each join is delivered, like a raid')
+    parser.add_argument('--workers', type=int, default=4, help='web.py event workers (WEB_WORKERS)')
+    args = parser.parse_args(argv)
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
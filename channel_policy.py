@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+import time
+
+from bot_framework.yaml_wrapper import yaml
+
+RELOAD_CHECK_INTERVAL = 2.0
+
+logger = logging.getLogger(__name__)
+
+
+def compile_policy(protected_channels):
+    """Turn {team: {channel: [allowed users]}} into {(team, channel): frozenset(allowed users)}"""
+    return {(team, channel): frozenset(allowed_users or ())
+            for team, channels in (protected_channels or {}).items()
+            for channel, allowed_users in (channels or {}).items()}
+
+
+class ChannelPolicy:
+    """Who may stay in the protected channels, compiled once and rebuilt when the policy file changes"""
+
+    def __init__(self, path=None, protected_channels=None):
+        self.path = path
+        self._index = compile_policy(protected_channels)
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        if path:
+            self.reload()
+
+    def __len__(self):
+        return len(self._index)
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding='utf8') as f:
+            protected_channels = yaml.load(f)
+        # swap the whole index at once, so readers see either the old or the new one
+        self._index = compile_policy(protected_channels)
+        self._mtime = mtime
+        logger.info(f"Loaded {len(self._index)} protected channels from {self.path}")
+
+    def _check_for_changes(self):
+        now = time.monotonic()
+        if not self.path or now < self._next_check:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + RELOAD_CHECK_INTERVAL
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime != self._mtime:
+                # noinspection PyBroadException
+                try:
+                    self.reload()
+                except Exception:
+                    logger.exception(f'Could not reload {self.path}, keeping the previous policy')
+        finally:
+            self._reload_lock.release()
+
+    def should_kick(self, team, channel, user):
+        self._check_for_changes()
+        allowed_users = self._index.get((team, channel))
+        return allowed_users is not None and user not in allowed_users
@@ -0,0 +1,152 @@
+import collections
+import logging
+import threading
+import time
+
+import slack
+
+import metrics
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_SIZE = 10000
+PAGE_SIZE = 200
+CONVERSATION_TYPES = 'public_channel,private_channel,mpim,im'
+# users.list is a tier 2 method, a big workspace gets rate limited before the last page
+MAX_RATELIMITED_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+ENTRY_AGE = metrics.histogram(
+    'slackbot_directory_entry_age_seconds', 'Age of the Slack directory cache entries when they are read', ('cache',),
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 86400))
+
+
+class TTLCache:
+    """Dict-like cache for Slack directory entries.
+
+    Entries expire `ttl` seconds after they were stored, and the least recently used ones are evicted when
+    there are more than `max_size`."""
+
+    def __init__(self, name, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            self.stats['expired'] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            self.stats['hits' if entry is not None else 'misses'] += 1
+        if entry is None:
+            return default
+        ENTRY_AGE.observe(time.monotonic() - entry[0], self.name)
+        return entry[1]
+
+    def peek(self, key, default=None):
+        """Like get, but without counting a hit or making the entry more recent"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[1] if entry is not None else default
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._entries[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else default
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        """Snapshot of the (key, value) pairs, expired entries included until they are next looked up"""
+        with self._lock:
+            return [(key, value) for key, (_, value) in self._entries.items()]
+
+    def is_full(self):
+        return len(self._entries) >= self.max_size
+
+
+def _page(method, cursor, **kwargs):
+    """One page of a list method, waiting for Retry-After when it is rate limited"""
+    attempt = 1
+    while True:
+        try:
+            return method(limit=PAGE_SIZE, cursor=cursor, **kwargs) if cursor else method(limit=PAGE_SIZE, **kwargs)
+        except slack.errors.SlackApiError as ex:
+            if ex.response.get('error') != 'ratelimited' or attempt >= MAX_RATELIMITED_ATTEMPTS:
+                raise
+            retry_after = float(ex.response.headers.get('Retry-After', 1))
+            logger.info(f"Listing the directory is rate limited, resuming in {retry_after}s")
+            time.sleep(retry_after)
+            attempt += 1
+
+
+def paginate(method, items_key, **kwargs):
+    """Yield the items of a cursor-paginated Web API list method (users_list, conversations_list...)"""
+    cursor = None
+    while True:
+        response = _page(method, cursor, **kwargs)
+        if not response['ok']:
+            return
+        yield from response[items_key]
+        cursor = (response.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+def warm(web_client, users, channels):
+    """Fill the user and channel caches with a few paginated list calls, instead of one info call per entry"""
+    started = time.monotonic()
+    # one list failing leaves the other to be warmed, and the entries already listed stay cached
+    try:
+        for user in paginate(web_client.users_list, 'members'):
+            users[user['id']] = user
+            if users.is_full():
+                break
+    except slack.errors.SlackApiError:
+        logger.exception(f"Could not list the users, {len(users)} cached")
+    try:
+        for channel in paginate(web_client.conversations_list, 'channels',
+                                types=CONVERSATION_TYPES, exclude_archived=True):
+            channels[channel['id']] = channel
+            if channels.is_full():
+                break
+    except slack.errors.SlackApiError:
+        logger.exception(f"Could not list the channels, {len(channels)} cached")
+    logger.info(f"Directory warmed with {len(users)} users and {len(channels)} channels "
+                f"in {time.monotonic() - started:.2f}s")
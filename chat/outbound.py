@@ -0,0 +1,246 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import slack
+
+import metrics
+
+PRIORITY_ERROR = 0
+PRIORITY_EPHEMERAL = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BULK = 3
+
+# requests per minute, from https://api.slack.com/docs/rate-limits
+# chat.postMessage is "special": about one message per second per channel
+METHOD_LIMITS = {
+    'chat_postMessage': 60,
+    'chat_postEphemeral': 100,  # tier 4
+    'files_upload': 20,  # tier 2
+    'files_getUploadURLExternal': 20,
+    'files_completeUploadExternal': 20,
+}
+DEFAULT_LIMIT = 50  # tier 3
+PER_CHANNEL_METHODS = {'chat_postMessage'}
+MAX_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_SENT = metrics.counter(
+    'slackbot_outbound_messages_total', 'Messages delivered by the outbound queue', ('method', 'outcome'))
+THROTTLED_SECONDS = metrics.counter(
+    'slackbot_outbound_throttled_seconds_total', 'Time spent waiting for Slack rate limits', ('method', 'reason'))
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, self.rate * 3)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until a call may be made, 0 if a token is available"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block_for(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutboundQueue:
+    """Delivers Slack Web API calls in the background, following per-method rate limits.
+
+    The calls for one channel are delivered in the order they were submitted. Between channels, the one whose
+    next call has the lower priority number goes first (errors, then ephemeral replies, then normal output,
+    then files). `ratelimited` responses pause the method for Retry-After seconds and the call is retried."""
+
+    def __init__(self, name='outbound', limits=None):
+        self.name = name
+        self.limits = dict(METHOD_LIMITS, **(limits or {}))
+        self._buckets = {}
+        self._channels = {}  # channel -> deque of [priority, sequence, web_client, method, kwargs, callbacks, attempt]
+        self._ready = []  # (priority, sequence, channel) of the first call of each channel that may be sent
+        self._throttled = []  # (monotonic time it may be sent, sequence, channel)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._queued = 0
+        self._in_flight = 0
+        self._sending = None  # channel of the call in flight, it is scheduled again once that call is done
+        self._thread = threading.Thread(target=self._run, name=f'{name}-sender', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._condition:
+            return self._queued + self._in_flight
+
+    def submit(self, priority, web_client, method, kwargs, on_error=None, on_result=None, channel=None):
+        if channel is None:
+            channel = kwargs.get('channel') or kwargs.get('channels')
+        with self._condition:
+            channel_queue = self._channels.get(channel)
+            if channel_queue is None:
+                channel_queue = self._channels[channel] = collections.deque()
+            channel_queue.append((priority, next(self._sequence), web_client, method, kwargs, (on_error, on_result), 1))
+            self._queued += 1
+            if len(channel_queue) == 1 and channel != self._sending:
+                self._schedule(channel)
+            self._condition.notify()
+
+    def call(self, priority, web_client, method, kwargs, channel=None):
+        """Submit a call and wait for its response. It is made after the calls already queued for the channel."""
+        done = threading.Event()
+        outcome = {}
+
+        def on_result(result):
+            outcome['result'] = result
+            done.set()
+
+        def on_error(ex):
+            outcome['error'] = ex
+            done.set()
+
+        self.submit(priority, web_client, method, kwargs, on_error, on_result, channel)
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def join(self, timeout=None):
+        """Wait until everything submitted so far has been delivered (or given up)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._queued or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _bucket(self, method, kwargs):
+        key = (method, kwargs.get('channel')) if method in PER_CHANNEL_METHODS else method
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(self.limits.get(method, DEFAULT_LIMIT))
+        return self._buckets[key]
+
+    def _schedule(self, channel):
+        priority, sequence = self._channels[channel][0][:2]
+        heapq.heappush(self._ready, (priority, sequence, channel))
+
+    def _next_ready(self):
+        """Pop the most important call that isn't throttled, or return how long to wait and for which method.
+
+        A channel whose next call is throttled is set aside until its bucket allows it, instead of being
+        looked at again for every call."""
+        now = time.monotonic()
+        while self._throttled and self._throttled[0][0] <= now:
+            self._schedule(heapq.heappop(self._throttled)[2])
+        while self._ready:
+            channel = heapq.heappop(self._ready)[2]
+            item = self._channels[channel][0]
+            wait = self._bucket(item[3], item[4]).wait_time()
+            if wait == 0:
+                return channel, None, None
+            heapq.heappush(self._throttled, (now + wait, item[1], channel))
+        if not self._throttled:
+            return None, None, None
+        ready_at, _, channel = self._throttled[0]
+        return None, max(ready_at - now, 0.0), self._channels[channel][0][3]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                channel, wait, method = self._next_ready()
+                while channel is None:
+                    started = time.monotonic()
+                    self._condition.wait(wait)
+                    if wait is not None:
+                        THROTTLED_SECONDS.inc(method, 'bucket', amount=time.monotonic() - started)
+                    channel, wait, method = self._next_ready()
+                item = self._channels[channel].popleft()
+                self._bucket(item[3], item[4]).take()
+                self._queued -= 1
+                self._in_flight += 1
+                self._sending = channel
+            retry = None
+            try:
+                retry = self._deliver(item)
+            finally:
+                with self._condition:
+                    channel_queue = self._channels[channel]
+                    if retry is not None:
+                        # the retry keeps its place ahead of the channel's later calls
+                        channel_queue.appendleft(retry)
+                        self._queued += 1
+                    if channel_queue:
+                        self._schedule(channel)
+                    else:
+                        del self._channels[channel]
+                    self._sending = None
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _deliver(self, item):
+        """Make the call, returns the item to retry if it was rate limited"""
+        priority, sequence, web_client, method, kwargs, (on_error, on_result), attempt = item
+        try:
+            result = call_method(web_client, method, kwargs)
+            MESSAGES_SENT.inc(method, 'ok')
+        except slack.errors.SlackApiError as ex:
+            if ex.response.get('error') == 'ratelimited' and attempt < MAX_ATTEMPTS:
+                retry_after = float(ex.response.headers.get('Retry-After', 1))
+                logger.warning(f"{method} is rate limited, retrying in {retry_after}s")
+                THROTTLED_SECONDS.inc(method, 'retry_after', amount=retry_after)
+                MESSAGES_SENT.inc(method, 'ratelimited')
+                with self._condition:
+                    # Retry-After applies to the whole method, not just this channel
+                    for key, bucket in self._buckets.items():
+                        if (key[0] if isinstance(key, tuple) else key) == method:
+                            bucket.block_for(retry_after)
+                return priority, sequence, web_client, method, kwargs, (on_error, on_result), attempt + 1
+            MESSAGES_SENT.inc(method, 'error')
+            self._report(method, on_error, ex)
+            return None
+        except Exception as ex:
+            MESSAGES_SENT.inc(method, 'error')
+            self._report(method, on_error, ex)
+            return None
+        if on_result is not None:
+            on_result(result)
+        return None
+
+    @staticmethod
+    def _report(method, on_error, ex):
+        if on_error is None:
+            logger.error(f"Could not deliver {method}: {ex!r}")
+            return
+        # noinspection PyBroadException
+        try:
+            on_error(ex)
+        except Exception:
+            logger.exception(f"Could not report failed {method}")
+
+
+def call_method(web_client, method, kwargs):
+    function = getattr(web_client, method, None)
+    if function is None:
+        # methods that are newer than slackclient (files.getUploadURLExternal...) go through api_call
+        return web_client.api_call(method.replace('_', '.', 1), **kwargs)
+    return function(**kwargs)
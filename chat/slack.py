@@ -1,44 +1,265 @@
+import collections
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
 import slack
 
+import metrics
+from chat import directory, upload
+from chat.outbound import PRIORITY_BULK, PRIORITY_EPHEMERAL, PRIORITY_ERROR, PRIORITY_NORMAL, call_method
+
+# Slack truncates messages above 40000 characters, but long messages are hard to read well before that
+MAX_COALESCED_LENGTH = 3500
+MEMBER_LOOKUP_WORKERS = 4
+
+DIRECTORY_CHANGES = metrics.counter(
+    'slackbot_directory_changes_total', 'Cached Slack entries that an event found out of date', ('cache',))
+
+
 class SlackWrapper:
-    def __init__(self, bot_name):
+    """What the messages of one Slack connection share: the Web API client, the directory caches and the
+    outbound queue. Each message gets a SlackContext from context()."""
+
+    def __init__(self, bot_name, coalesce=False, outbound=None,
+                 directory_ttl=directory.DEFAULT_TTL, directory_size=directory.DEFAULT_MAX_SIZE):
         self.bot_name = bot_name
-        self.users = {}
-        self.teams = {}
-        self.channels = {}
+        self.coalesce = coalesce
+        self.outbound = outbound
+        self.users = directory.TTLCache('users', directory_ttl, directory_size)
+        self.teams = directory.TTLCache('teams', directory_ttl, directory_size)
+        self.channels = directory.TTLCache('channels', directory_ttl, directory_size)
+        self.channel_members = directory.TTLCache('channel_members', directory_ttl, directory_size)
+        self.channel_labels = directory.TTLCache('channel_labels', directory_ttl, directory_size)
+        # the labels of direct message channels need every participant's name
+        self._lookup_pool = ThreadPoolExecutor(MEMBER_LOOKUP_WORKERS, thread_name_prefix='slack-lookup')
         self.web_client = None
-        self.team_id = None
-        self.channel_id = None
-        self.user_id = None
-        self.message = None
-        self.permalink = None
-
-    def load(self, web_client, team_id, channel_id, user_id, msg, permalink):
-        self.web_client = web_client
+        self._raw_web_client = None
+        self.api_calls_skipped = collections.Counter()
+        self._api_calls_skipped_lock = threading.Lock()
+        self._warmed_at = None
+
+    def context(self, web_client, team_id, channel_id, user_id, msg):
+        if web_client is not self._raw_web_client:
+            # the RTM client hands the same WebClient to every event
+            self.web_client = metrics.InstrumentedClient(web_client, 'slack')
+            self._raw_web_client = web_client
+        return SlackContext(self, team_id, channel_id, user_id, msg)
+
+    def _send(self, priority, method, on_error=None, **kwargs):
+        """Hand a Web API call to the outbound queue, or make it right away without one"""
+        if self.outbound is not None:
+            self.outbound.submit(priority, self.web_client, method, kwargs, on_error)
+            return
+        try:
+            getattr(self.web_client, method)(**kwargs)
+        except slack.errors.SlackApiError as ex:
+            if on_error is None:
+                raise
+            on_error(ex)
+
+    def _call(self, priority, method, channel_id, **kwargs):
+        """Make a Web API call and return its response, through the outbound queue when there is one.
+
+        The call waits for the calls already queued for the channel, and for the method's rate limit."""
+        if self.outbound is not None:
+            return self.outbound.call(priority, self.web_client, method, kwargs, channel=channel_id)
+        return call_method(self.web_client, method, kwargs)
+
+    def warm_directory(self, web_client):
+        # hello comes again after every reconnect, the directory is only listed again once the caches expire
+        if self._warmed_at is not None and time.monotonic() - self._warmed_at < self.users.ttl:
+            return
+        self._warmed_at = time.monotonic()
+        directory.warm(metrics.InstrumentedClient(web_client, 'slack'), self.users, self.channels)
+
+    def slack_user_info(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            response_user = self.web_client.users_info(user=user_id)
+            if response_user['ok']:
+                user = self.users[user_id] = response_user['user']
+        return user
+
+    def slack_team_info(self, team_id):
+        team = self.teams.get(team_id)
+        if team is None:
+            response_team = self.web_client.team_info()
+            if response_team['ok']:
+                team = self.teams[team_id] = response_team['team']
+        return team
+
+    def slack_conversation_info(self, channel_id):
+        channel_info = self.channels.get(channel_id)
+        if channel_info is None:
+            response_channel = self.web_client.conversations_info(channel=channel_id)
+            channel_info = response_channel['channel'] if response_channel['ok'] else {}
+            if channel_info:
+                self.channels[channel_id] = channel_info
+        return channel_info
+
+    def slack_users_info(self, user_ids):
+        """Look up several users, fetching the ones that aren't cached in parallel"""
+        missing = [user_id for user_id in user_ids if user_id not in self.users]
+        if len(missing) > 1:
+            list(self._lookup_pool.map(self.slack_user_info, missing))
+        return [self.slack_user_info(user_id) for user_id in user_ids]
+
+    def slack_channel_members(self, channel_id):
+        members = self.channel_members.get(channel_id)
+        if members is None:
+            members = self.channel_members[channel_id] = self.web_client.conversations_members(
+                channel=channel_id)['members']
+        return members
+
+    def slack_channel_info(self, team_id, channel_id):
+        label = self.channel_labels.get(channel_id)
+        if label is None:
+            channel_info = self.slack_conversation_info(channel_id)
+            if channel_info.get('is_im') or channel_info.get('is_mpim'):
+                members = [user for user in self.slack_users_info(self.slack_channel_members(channel_id)) if user]
+                label = '🧑' + ' '.join(f"{user['real_name']} <{user['name']}@{user['id']}>" for user in members)
+            elif channel_info.get('is_group') or channel_info.get('is_channel'):
+                priv = '🔒' if channel_info.get('is_private') else '#'
+                label = priv + channel_info['name_normalized']
+            if label is not None:
+                self.channel_labels[channel_id] = label
+        return label
+
+    # The RTM events below keep the caches current, instead of waiting for the entries to expire
+
+    def update_user(self, user):
+        """user_change, team_join"""
+        previous = self.users.peek(user['id'])
+        self.users[user['id']] = user
+        if previous is not None and previous != user:
+            DIRECTORY_CHANGES.inc('users')
+            # direct message labels show the participants' names
+            for channel_id in self._channels_with_member(user['id']):
+                self.channel_labels.pop(channel_id)
+
+    def update_channel(self, channel, is_private=False):
+        """channel_rename, group_rename, channel_created"""
+        previous = self.channels.peek(channel['id'])
+        channel_info = dict(previous or {'is_channel': not is_private, 'is_group': is_private, 'is_private': is_private},
+                            **channel)
+        if 'name_normalized' not in channel:
+            channel_info['name_normalized'] = channel_info['name']
+        self.channels[channel['id']] = channel_info
+        if previous is not None and previous.get('name_normalized') != channel_info['name_normalized']:
+            DIRECTORY_CHANGES.inc('channels')
+        self.channel_labels.pop(channel['id'])
+
+    def add_channel_member(self, channel_id, user_id):
+        """member_joined_channel"""
+        members = self.channel_members.peek(channel_id)
+        if members is not None and user_id not in members:
+            self.channel_members[channel_id] = members + [user_id]
+            DIRECTORY_CHANGES.inc('channel_members')
+            self.channel_labels.pop(channel_id)
+
+    def _channels_with_member(self, user_id):
+        return [channel_id for channel_id, members in self.channel_members.items() if user_id in members]
+
+
+class SlackContext:
+    """One message: where replies go, who sent it, and the replies held back while coalescing.
+
+    Everything else (bot_name, web_client, the caches and their lookups) is read from the SlackWrapper."""
+    __slots__ = ('wrapper', 'team_id', 'channel_id', 'user_id', 'message', '_permalink', '_coalesced',
+                 '_coalesced_icon')
+
+    def __init__(self, wrapper, team_id, channel_id, user_id, msg):
+        self.wrapper = wrapper
         self.team_id = team_id
         self.channel_id = channel_id
         self.user_id = user_id
         self.message = msg
-        self.permalink = permalink
+        self._permalink = None
+        self._coalesced = None
+        self._coalesced_icon = None
+
+    def __getattr__(self, name):
+        return getattr(self.wrapper, name)
+
+    @property
+    def permalink(self):
+        if self._permalink is None:
+            self._permalink = self.web_client.chat_getPermalink(channel=self.channel_id, message_ts=self.message['ts'])
+        return self._permalink
+
+    @property
+    def user(self):
+        return self.slack_user_info(self.user_id)
+
+    @property
+    def team(self):
+        return self.slack_team_info(self.team_id)
+
+    def count_skipped_calls(self):
+        """Count the lookups this message never needed (they used to be made for every message)"""
+        skipped = []
+        if self._permalink is None:
+            skipped.append('chat_getPermalink')
+        if self.team_id not in self.teams:
+            skipped.append('team_info')
+        if self.user_id not in self.users:
+            skipped.append('users_info')
+        if self.channel_id not in self.channel_labels:
+            skipped.append('conversations_info')
+        with self._api_calls_skipped_lock:
+            self.api_calls_skipped.update(skipped)
 
-    def preload(self, user_id, team_id, channel_id):
-        self.slack_team_info(team_id)
-        self.slack_user_info(user_id)
-        self.slack_channel_info(team_id, channel_id)
+    @contextmanager
+    def coalescing(self):
+        """Join consecutive send_text calls with the same icon into as few messages as possible"""
+        if not self.coalesce or self._coalesced is not None:
+            yield
+            return
+        self._coalesced = []
+        try:
+            yield
+        finally:
+            self.flush()
+            self._coalesced = None
+
+    def flush(self):
+        if self._coalesced:
+            text = '\n'.join(self._coalesced)
+            self._coalesced.clear()
+            self._post_text(text, self._coalesced_icon)
 
     def send_text(self, text, is_error=False, icon_emoji=None):
         if icon_emoji is None:
             icon_emoji = ':robot_face:' if not is_error else ':face_palm:'
-        self.web_client.chat_postMessage(
+        if self._coalesced is None:
+            self._post_text(text, icon_emoji)
+            return
+        pending_length = sum(len(t) + 1 for t in self._coalesced)
+        if icon_emoji != self._coalesced_icon or pending_length + len(text) > MAX_COALESCED_LENGTH:
+            self.flush()
+        self._coalesced_icon = icon_emoji
+        self._coalesced.append(text)
+
+    def _post_text(self, text, icon_emoji):
+        self._send(
+            PRIORITY_ERROR if icon_emoji == ':face_palm:' else PRIORITY_NORMAL,
+            'chat_postMessage',
             channel=self.channel_id,
             text=text,
             icon_emoji=icon_emoji,
             username=self.bot_name)
 
     def send_ephemeral(self, text=None, blocks=None, is_error=False, icon_emoji=None):
+        self.flush()
         if icon_emoji is None:
             icon_emoji = ':robot_face:' if not is_error else ':face_palm:'
-        self.web_client.chat_postEphemeral(
+        self._send(
+            PRIORITY_ERROR if is_error else PRIORITY_EPHEMERAL,
+            'chat_postEphemeral',
             channel=self.channel_id,
             blocks=blocks,
             text=text,
@@ -47,20 +268,43 @@ class SlackWrapper:
             username=self.bot_name)
 
     def send_file(self, file_data, title=None, filename=None, filetype=None):
-        try:
-            self.web_client.files_upload(
-                channels=self.channel_id,
-                icon_emoji=':robot_face:',
-                username=self.bot_name,
-                file=file_data,
-                filename=filename,
-                title=title,
-                filetype=filetype or 'auto')
-        except slack.errors.SlackApiError as ex:
+        """Upload bytes (or str), a pathlib.Path, a binary file object or an iterator of bytes chunks.
+
+        Anything but bytes is streamed through Slack's external upload flow, in the calling thread,
+        so the file object can be closed as soon as this returns. Its Web API calls still go through the
+        outbound queue, after the messages this channel already has queued."""
+        self.flush()
+
+        def upload_failed(ex):
             self.send_text(text=f"Error while uploading {filename}:\n```{ex!r}```", is_error=True)
 
+        if isinstance(file_data, str):
+            file_data = file_data.encode('utf8')
+        if not isinstance(file_data, (bytes, bytearray)):
+            try:
+                upload.upload(functools.partial(self._call, PRIORITY_BULK, channel_id=self.channel_id),
+                              self.channel_id, file_data, filename, title, filetype)
+            except (slack.errors.SlackApiError, requests.RequestException, OSError) as ex:
+                upload_failed(ex)
+            return
+
+        self._send(
+            PRIORITY_BULK,
+            'files_upload',
+            on_error=upload_failed,
+            channels=self.channel_id,
+            icon_emoji=':robot_face:',
+            username=self.bot_name,
+            file=file_data,
+            filename=filename,
+            title=title,
+            filetype=filetype or 'auto')
+
     def send_fields(self, text, fields):
-        self.web_client.chat_postMessage(
+        self.flush()
+        self._send(
+            PRIORITY_NORMAL,
+            'chat_postMessage',
             channel=self.channel_id,
             icon_emoji=':robot_face:',
             text=text,
@@ -68,41 +312,15 @@ class SlackWrapper:
             attachments=fields)
 
     def send_blocks(self, blocks):
-        self.web_client.chat_postMessage(
+        self.flush()
+        self._send(
+            PRIORITY_NORMAL,
+            'chat_postMessage',
             channel=self.channel_id,
             icon_emoji=':robot_face:',
             blocks=blocks,
             username=self.bot_name)
 
-    def slack_user_info(self, user_id):
-        if user_id not in self.users:
-            response_user = self.web_client.users_info(user=user_id)
-            if response_user['ok']:
-                self.users[user_id] = response_user['user']
-
-    def slack_team_info(self, team_id):
-        if team_id not in self.teams:
-            response_team = self.web_client.team_info()
-            if response_team['ok']:
-                self.teams[team_id] = response_team['team']
-
-    def slack_channel_info(self, team_id, channel_id):
-        if team_id not in self.channels:
-            self.channels[team_id] = {}
-        if channel_id not in self.channels[team_id]:
-            response_channel = self.web_client.conversations_info(channel=channel_id)
-            channel_info = response_channel['channel'] if response_channel['ok'] else {}
-            if channel_info.get('is_group') or channel_info.get('is_channel'):
-                priv = '🔒' if channel_info.get('is_private') else '#'
-                self.channels[team_id][channel_id] = priv + channel_info['name_normalized']
-            elif channel_info.get('is_im'):
-                response_members = self.web_client.conversations_members(channel=channel_id)
-                for user_id in response_members['members']:
-                    self.slack_user_info(user_id)
-                participants = [f"{self.users[user_id]['real_name']} <{self.users[user_id]['name']}@{user_id}>"
-                                for user_id in response_members['members']]
-                self.channels[team_id][channel_id] = '🧑' + ' '.join(participants)
-
     @property
     def channel_name(self):
-        return self.channels[self.team_id].get(self.channel_id)
+        return self.slack_channel_info(self.team_id, self.channel_id)
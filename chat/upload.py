@@ -0,0 +1,103 @@
+import io
+import logging
+import mimetypes
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import requests
+
+import metrics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# iterators are spooled to a temporary file (to learn their length), in memory up to this size
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+SPOOL_CHUNK_SIZE = 64 * 1024
+UPLOAD_TIMEOUT = 300
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SIZE = metrics.histogram(
+    'slackbot_upload_bytes', 'Size of the files uploaded to Slack', ('source',),
+    buckets=(1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912))
+UPLOAD_PEAK_RSS = metrics.histogram(
+    'slackbot_upload_peak_rss_increase_bytes', 'How much an upload raised the peak resident memory of the process',
+    ('source',), buckets=(0, 65536, 1048576, 8388608, 67108864, 536870912))
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, None where the resource module is missing"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def default_filename(filetype):
+    if not filetype or filetype == 'auto':
+        return 'file'
+    extension = mimetypes.guess_extension(filetype) if '/' in filetype else '.' + filetype
+    return 'file' + (extension or '')
+
+
+@contextmanager
+def open_payload(file_data):
+    """Yield (binary file object, length, source) for a path, a file object or an iterator of bytes chunks"""
+    if isinstance(file_data, os.PathLike):
+        with open(file_data, 'rb') as f:
+            yield f, os.fstat(f.fileno()).st_size, 'path'
+    elif hasattr(file_data, 'read'):
+        if file_data.seekable():
+            position = file_data.tell()
+            length = file_data.seek(0, io.SEEK_END) - position
+            file_data.seek(position)
+            yield file_data, length, 'file'
+        else:
+            with _spool(iter(lambda: file_data.read(SPOOL_CHUNK_SIZE), b'')) as (spooled, length):
+                yield spooled, length, 'stream'
+    else:
+        with _spool(file_data) as (spooled, length):
+            yield spooled, length, 'iterator'
+
+
+@contextmanager
+def _spool(chunks):
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT) as spooled:
+        length = 0
+        for chunk in chunks:
+            spooled.write(chunk)
+            length += len(chunk)
+        spooled.seek(0)
+        yield spooled, length
+
+
+def upload(api_call, channel_id, file_data, filename=None, title=None, filetype=None):
+    """Upload with Slack's external upload flow, streaming the payload instead of holding it in memory:
+    files.getUploadURLExternal, POST of the file to the returned URL, files.completeUploadExternal
+
+    The Web API calls are made with `api_call(method, **kwargs)`, which may hand them to the outbound queue."""
+    filename = filename or default_filename(filetype)
+    rss_before = peak_rss()
+    started = time.perf_counter()
+    with open_payload(file_data) as (stream, length, source):
+        response = api_call('files_getUploadURLExternal', data={'filename': filename, 'length': length})
+        with metrics.timed('slack', 'upload'):
+            posted = requests.post(response['upload_url'], data=stream, timeout=UPLOAD_TIMEOUT,
+                                   headers={'Content-Type': 'application/octet-stream'})
+            posted.raise_for_status()
+    api_call('files_completeUploadExternal',
+             json={'channel_id': channel_id, 'files': [{'id': response['file_id'], 'title': title or filename}]})
+    UPLOAD_SIZE.observe(length, source)
+    rss_increase = None
+    if rss_before is not None:
+        rss_increase = peak_rss() - rss_before
+        UPLOAD_PEAK_RSS.observe(rss_increase, source)
+    logger.info(f"Uploaded {filename} ({length} bytes from {source}) in {time.perf_counter() - started:.2f}s, "
+                f"peak memory grew by {rss_increase} bytes")
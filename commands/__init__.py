@@ -1,12 +1,55 @@
+import importlib
 import logging
+import threading
+import time
 
 import click
 import praw
 
 from chat.slack import SlackWrapper
 
+module_load_times = {}
+_module_load_lock = threading.Lock()
 
-class DefaultCommandGroup(click.Group):
+
+def load_command_module(module_name):
+    """Import a command module (which registers its commands) and record how long it took"""
+    with _module_load_lock:
+        if module_name in module_load_times:
+            return
+        started = time.perf_counter()
+        importlib.import_module(module_name)
+        module_load_times[module_name] = time.perf_counter() - started
+    logging.getLogger(__name__).info(f"Loaded {module_name} in {module_load_times[module_name]:.3f}s")
+
+
+class LazyCommand(click.Command):
+    """Placeholder for a command whose module is only imported when the command is first used"""
+
+    def __init__(self, name, module_name, short_help=None):
+        super().__init__(name, short_help=short_help)
+        self.module_name = module_name
+
+
+class CachedHelpMixin:
+    """Keep the rendered help of a group until its list of commands changes"""
+
+    def __init__(self, *args, **kwargs):
+        self._help_cache = {}
+        super().__init__(*args, **kwargs)
+
+    def add_command(self, cmd, name=None):
+        super().add_command(cmd, name)
+        self._help_cache.clear()
+
+    def get_help(self, ctx):
+        help_text = self._help_cache.get(ctx.command_path)
+        if help_text is None:
+            help_text = self._help_cache[ctx.command_path] = super().get_help(ctx)
+        return help_text
+
+
+class DefaultCommandGroup(CachedHelpMixin, click.Group):
     """allow a default command for a group"""
 
     def command(self, *args, **kwargs):
@@ -35,7 +78,7 @@ class DefaultCommandGroup(click.Group):
             return super().resolve_command(ctx, args)
 
 
-class ClickAliasedGroup(click.Group):
+class ClickAliasedGroup(CachedHelpMixin, click.Group):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._commands = {}
@@ -53,6 +96,7 @@ class ClickAliasedGroup(click.Group):
                 self._commands[cmd.name] = aliases
                 for alias in aliases:
                     self._aliases[alias] = cmd.name
+                self._help_cache.clear()
             return cmd
 
         return _decorator
@@ -69,10 +113,22 @@ class ClickAliasedGroup(click.Group):
                 self._commands[cmd.name] = aliases
                 for alias in aliases:
                     self._aliases[alias] = cmd.name
+                self._help_cache.clear()
             return cmd
 
         return _decorator
 
+    def add_lazy_command(self, module_name, name, aliases=(), short_help=None):
+        if name in self.commands and not isinstance(self.commands[name], LazyCommand):
+            # the module was already imported (e.g. by the modqueue poller), keep its real command
+            return
+        self.add_command(LazyCommand(name, module_name, short_help))
+        if aliases:
+            self._commands[name] = list(aliases)
+            for alias in aliases:
+                self._aliases[alias] = name
+            self._help_cache.clear()
+
     def resolve_alias(self, cmd_name):
         if cmd_name in self._aliases:
             return self._aliases[cmd_name]
@@ -81,6 +137,12 @@ class ClickAliasedGroup(click.Group):
     def get_command(self, ctx, cmd_name):
         cmd_name = self.resolve_alias(cmd_name)
         command = super(ClickAliasedGroup, self).get_command(ctx, cmd_name)
+        if isinstance(command, LazyCommand):
+            # importing the module replaces the placeholder with the real command
+            load_command_module(command.module_name)
+            command = super(ClickAliasedGroup, self).get_command(ctx, cmd_name)
+            if isinstance(command, LazyCommand):
+                raise click.ClickException(f"{command.module_name} did not define command {cmd_name}")
         if command:
             return command
 
@@ -90,7 +152,8 @@ class ClickAliasedGroup(click.Group):
         sub_commands = self.list_commands(ctx)
 
         for sub_command in sub_commands:
-            cmd = self.get_command(ctx, sub_command)
+            # not get_command, listing the commands shouldn't import the lazy ones
+            cmd = self.commands.get(sub_command)
             if cmd is None:
                 continue
             if hasattr(cmd, 'hidden') and cmd.hidden:
@@ -98,7 +161,7 @@ class ClickAliasedGroup(click.Group):
             if sub_command in self._commands:
                 aliases = ','.join(sorted(self._commands[sub_command]))
                 sub_command = '{0} ({1})'.format(sub_command, aliases)
-            cmd_help = cmd.short_help or ''
+            cmd_help = cmd.get_short_help_str()
             rows.append((sub_command, cmd_help))
 
         if rows:
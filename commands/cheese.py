@@ -6,6 +6,8 @@ import psycopg2
 
 from bot_framework.yaml_wrapper import yaml
 from commands import gyrobot, chat
+from file_lock import yaml_lock
+from metrics import timed
 
 SQL_CHEESE_VIEW = """\
 SELECT "objectData", "lastUpdate"
@@ -17,7 +19,7 @@ VALUES (%(machine_name)s, %(job_data)s);"""
 
 
 def config():
-    with open('data/cheese_agent.yml') as f:
+    with open('data/cheese_agent.yml') as f, yaml_lock:
         return yaml.load(f)
 
 
@@ -33,10 +35,12 @@ def _cheese_db_query(sql_cmd, cmd_vars, get_rows: bool):
     rows = None
     success = False
     database_url = os.environ['CHEESE_DATABASE_URL']
-    conn = psycopg2.connect(database_url)
+    with timed('postgres', 'connect'):
+        conn = psycopg2.connect(database_url)
     conn.autocommit = True
     cur = conn.cursor()
-    cur.execute(sql_cmd, vars=cmd_vars)
+    with timed('postgres', 'query'):
+        cur.execute(sql_cmd, vars=cmd_vars)
     if get_rows:
         descr = [col.name for col in cur.description]
         rows = cur.fetchall()
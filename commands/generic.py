@@ -4,6 +4,7 @@ import datetime
 import json
 import math
 import os
+import pathlib
 import random
 import re
 import subprocess
@@ -464,8 +465,7 @@ def weather(ctx, place):
     place_full = place_full.replace("?", "")
     if place_full in ('brexit', 'pompeii'):
         title = 'the floor is lava'
-        with open('img/lava.png', 'rb') as f:
-            file_data = f.read()
+        file_data = pathlib.Path('img/lava.png')
     else:
         weather_page = requests.get('http://wttr.in/' + place_full + '_p0.png?m')
         file_data = weather_page.content
@@ -8,6 +8,7 @@ import psycopg2
 from tabulate import tabulate
 
 from commands import gyrobot, chat, DefaultCommandGroup
+from metrics import timed
 
 SQL_KUDOS_INSERT = """\
 INSERT INTO kudos (
@@ -87,10 +88,8 @@ def kudos_give(ctx: click.Context):
     all_users = set(re.findall(r'<@(\w+)>', arg))
 
     for recipient_user_id in all_users:
-        chat(ctx).slack_user_info(recipient_user_id)
-        chat(ctx).slack_channel_info(chat(ctx).team_id, chat(ctx).channel_id)
-        recipient_name = chat(ctx).users[recipient_user_id]['name']
-        sender_name = chat(ctx).users[chat(ctx).user_id]['name']
+        recipient_name = chat(ctx).slack_user_info(recipient_user_id)['name']
+        sender_name = chat(ctx).user['name']
 
         if recipient_user_id == chat(ctx).user_id:
             chat(ctx).send_text("You can't give kudos to yourself, silly!", is_error=True)
@@ -118,9 +117,11 @@ def kudos_give(ctx: click.Context):
 @click.pass_context
 def kudos_view(ctx, days_to_check):
     database_url = os.environ['KUDOS_DATABASE_URL']
-    conn = psycopg2.connect(database_url)
+    with timed('postgres', 'connect'):
+        conn = psycopg2.connect(database_url)
     cur = conn.cursor()
-    cur.execute(SQL_KUDOS_VIEW, {'days': days_to_check})
+    with timed('postgres', 'query'):
+        cur.execute(SQL_KUDOS_VIEW, {'days': days_to_check})
     rows = cur.fetchall()
     cols = [col.name for col in cur.description]
     cur.close()
@@ -134,16 +135,18 @@ def kudos_view(ctx, days_to_check):
 
 def _record_kudos(ctx, sender_name, recipient_name, recipient_user_id, reason):
     database_url = os.environ['KUDOS_DATABASE_URL']
-    conn = psycopg2.connect(database_url)
+    with timed('postgres', 'connect'):
+        conn = psycopg2.connect(database_url)
     conn.autocommit = True
     cur = conn.cursor()
     cmd_vars = {
         'sender_name': sender_name, 'sender_id': chat(ctx).user_id,
         'recipient_name': recipient_name, 'recipient_id': recipient_user_id,
-        'team_name': chat(ctx).teams[chat(ctx).team_id]['name'], 'team_id': chat(ctx).team_id,
-        'channel_name': chat(ctx).channels[chat(ctx).team_id][chat(ctx).channel_id], 'channel_id': chat(ctx).channel_id,
+        'team_name': chat(ctx).team['name'], 'team_id': chat(ctx).team_id,
+        'channel_name': chat(ctx).channel_name, 'channel_id': chat(ctx).channel_id,
         'permalink': chat(ctx).permalink['permalink'], 'reason': reason}
-    cur.execute(SQL_KUDOS_INSERT, vars=cmd_vars)
+    with timed('postgres', 'query'):
+        cur.execute(SQL_KUDOS_INSERT, vars=cmd_vars)
     success = cur.rowcount > 0
     cur.close()
     conn.close()
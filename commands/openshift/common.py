@@ -1,11 +1,13 @@
 import os
 import pathlib
+import subprocess
 from functools import update_wrapper
 
 import click
 from ruamel.yaml import YAML
 
 from commands import chat
+from metrics import timed
 
 yaml = YAML()
 all_users = []
@@ -27,6 +29,16 @@ def read_config(env_var):
     return config
 
 
+def run_oc(cmd_line, **kwargs):
+    """subprocess.run for oc, counted and timed per oc subcommand"""
+    with timed('oc', cmd_line[1]):
+        return subprocess.run(cmd_line, **kwargs)
+
+
+def check_output_oc(cmd_line):
+    return run_oc(cmd_line, stdout=subprocess.PIPE, check=True).stdout
+
+
 class OpenShiftNamespace(click.ParamType):
     name = 'namespace'
     _config = {}
@@ -32,7 +32,9 @@ def list_deployments(ctx, namespace, excel: bool):
         deployments_df = pd.DataFrame(deployments)
         with io.BytesIO() as deployments_output:
             deployments_df.reset_index(drop=True).to_excel(deployments_output)
-            chat(ctx).send_file(deployments_output.getvalue(), filename='deployments.xlsx')
+            del deployments_df
+            deployments_output.seek(0)
+            chat(ctx).send_file(deployments_output, filename='deployments.xlsx')
     else:
         deployments = [{k: v for k, v in dep.items() if k not in REMOVE_DEPLOYMENT_KEYS} for dep in deployments]
         deployments_markdown = tabulate(deployments, headers='keys', tablefmt='fancy_outline')
@@ -2,12 +2,12 @@ import json
 import os
 import pathlib
 import re
-import subprocess
 from string import Template
 
 import click
 
 from commands import gyrobot, chat
+from commands.openshift.common import run_oc, check_output_oc
 
 
 def _mock_config():
@@ -90,7 +90,7 @@ def mock(ctx, environment, mock_status):
 
     oc_token = mock_config['environments'][environment]['openshift_token']
     site = mock_config['environments'][environment]['site']
-    login_cmd = subprocess.run(['oc', 'login', site, f'--token={oc_token}'], capture_output=True)
+    login_cmd = run_oc(['oc', 'login', site, f'--token={oc_token}'], capture_output=True)
     login_result = login_cmd.stderr.decode().strip()
     if login_cmd.returncode != 0:
         chat(ctx).send_text(f"Error while logging in:\n```{login_result}```", is_error=True)
@@ -100,7 +100,7 @@ def mock(ctx, environment, mock_status):
     chat(ctx).send_text(f"Setting mock status to {mock_status} for project {environment}...")
     project_name = _get_project_name(mock_config, environment)
     change_project_command = ['oc', 'project', project_name]
-    result_text += subprocess.check_output(change_project_command).decode() + '\n' * 3
+    result_text += check_output_oc(change_project_command).decode() + '\n' * 3
     statuses = mock_config['environments'][environment]['status'][mock_status]
     vartemplates = mock_config['environments'][environment].get('vartemplate', {})
     for name, value in vartemplates.items(): # check that there's no recursive loop
@@ -118,9 +118,9 @@ def mock(ctx, environment, mock_status):
         while '$' in env_variable_value:
             env_variable_value = Template(env_variable_value).substitute(**vartemplates)
         environment_set_command = ['oc', 'set', 'env', prefix + microservice, env_variable_value]
-        result_text += subprocess.check_output(environment_set_command).decode() + '\n\n'
+        result_text += check_output_oc(environment_set_command).decode() + '\n\n'
     logout_command = ['oc', 'logout']
-    result_text += subprocess.check_output(logout_command).decode() + '\n\n'
+    result_text += check_output_oc(logout_command).decode() + '\n\n'
     result_text = re.sub('\n{2,}', '\n', result_text)
     chat(ctx).send_text('```' + result_text + '```')
 
@@ -135,15 +135,15 @@ def check_mock(ctx, environment):
         chat(ctx).send_text(f"You don't have permission to view mock status.", is_error=True)
     oc_token = mock_config['environments'][environment]['openshift_token']
     site = mock_config['environments'][environment]['site']
-    result_text = subprocess.check_output(['oc', 'login', site, f'--token={oc_token}']).decode() + '\n' * 3
+    result_text = check_output_oc(['oc', 'login', site, f'--token={oc_token}']).decode() + '\n' * 3
     prefix = mock_config['environments'][environment]['prefix']
     project_name = _get_project_name(mock_config, environment)
-    result_text += subprocess.check_output(['oc', 'project', project_name]).decode() + '\n' * 3
+    result_text += check_output_oc(['oc', 'project', project_name]).decode() + '\n' * 3
     first_status = list(mock_config['environments'][environment]['status'].keys())[0]
     microservices = list(mock_config['environments'][environment]['status'][first_status].keys())
     for microservice in microservices:
-        env_var_list = subprocess.check_output(['oc', 'env', prefix + microservice, '--list']).decode()
+        env_var_list = check_output_oc(['oc', 'env', prefix + microservice, '--list']).decode()
         env_var_list = _masked_oc_password(env_var_list)
         result_text += env_var_list + '\n\n'
-    result_text += subprocess.check_output(['oc', 'logout']).decode() + '\n\n'
+    result_text += check_output_oc(['oc', 'logout']).decode() + '\n\n'
     chat(ctx).send_file(result_text.encode(), title='OpenShift Data', filename='openshift-data.txt')
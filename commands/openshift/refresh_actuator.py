@@ -5,7 +5,7 @@ import click
 import requests
 
 from commands import gyrobot, chat, logger
-from commands.openshift.common import read_config, user_allowed, OpenShiftNamespace
+from commands.openshift.common import read_config, user_allowed, OpenShiftNamespace, run_oc
 
 
 def _actuator_config():
@@ -46,7 +46,7 @@ def refresh_actuator(ctx, namespace, deployments):
             return
         all_pods = all_pods_raw.json()
 
-        login_cmd = subprocess.run(['oc', 'login', f'--token={openshift_token}', f'--server={server_url}'], capture_output=True)
+        login_cmd = run_oc(['oc', 'login', f'--token={openshift_token}', f'--server={server_url}'], capture_output=True)
         if login_cmd.returncode != 0:
             chat(ctx).send_text("Error while logging in:\n```" + login_cmd.stderr.decode().strip() + "```", is_error=True)
             return
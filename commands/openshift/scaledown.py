@@ -1,9 +1,8 @@
-import subprocess
 import shlex
 
 import click
 import requests
-from commands.openshift.common import read_config, user_allowed, OpenShiftNamespace
+from commands.openshift.common import read_config, user_allowed, OpenShiftNamespace, run_oc
 from ruamel.yaml import YAML
 
 from commands import gyrobot, chat, logger
@@ -37,24 +36,24 @@ def scaledown(ctx, namespace):
 
     result = ""
 
-    login_cmd = subprocess.run(['oc', 'login', f'--token={openshift_token}', f'--server={server_url}'], capture_output=True)
+    login_cmd = run_oc(['oc', 'login', f'--token={openshift_token}', f'--server={server_url}'], capture_output=True)
     if login_cmd.returncode != 0:
         chat(ctx).send_text("Error while logging in:\n```" + login_cmd.stderr.decode().strip() + "```", is_error=True)
         return
 
-    whoami_cmd = subprocess.run(['oc', 'whoami'], capture_output=True)
+    whoami_cmd = run_oc(['oc', 'whoami'], capture_output=True)
     result += whoami_cmd.stdout.decode() + '\n'
 
-    change_project_cmd = subprocess.run(['oc', 'project', namespace], capture_output=True)
+    change_project_cmd = run_oc(['oc', 'project', namespace], capture_output=True)
     if change_project_cmd.returncode != 0:
         chat(ctx).send_text(f"Error while selecting project {namespace} in:\n```" + change_project_cmd.stderr.decode().strip() + "```", is_error=True)
         return
 
-    project_cmd = subprocess.run(['oc', 'project'], capture_output=True)
+    project_cmd = run_oc(['oc', 'project'], capture_output=True)
     result += project_cmd.stdout.decode() + '\n'
 
     deployments_to_scaledown_cmd_line = ['oc', 'get', '-o', 'go-template={{range .items}}{{.metadata.name}}{{"\\n"}}{{end}}', 'deployment']
-    deployments_to_scaledown_cmd = subprocess.run(deployments_to_scaledown_cmd_line, capture_output=True)
+    deployments_to_scaledown_cmd = run_oc(deployments_to_scaledown_cmd_line, capture_output=True)
     if deployments_to_scaledown_cmd.returncode != 0:
         chat(ctx).send_text(f"Error while retrieveing deployments:\n```" + deployments_to_scaledown_cmd.stderr.decode().strip() + "```", is_error=True)
         return
@@ -70,7 +69,7 @@ def scaledown(ctx, namespace):
         result += "\n"
         scaledown_cmd_line = ['oc', 'scale', 'deployment', deployment_to_scaledown, '--replicas=0']
         result += shlex.join(scaledown_cmd_line)
-        scaledown_cmd = subprocess.run(scaledown_cmd_line, capture_output=True)
+        scaledown_cmd = run_oc(scaledown_cmd_line, capture_output=True)
         if scaledown_cmd.returncode != 0:
             result += f"\nError {scaledown_cmd.returncode} while scaling down deployment {deployment_to_scaledown} to scale down\n"
         result += scaledown_cmd.stdout.decode().strip() + "\n"
@@ -79,20 +78,20 @@ def scaledown(ctx, namespace):
     for resource_to_scaledown in namespace_obj['resources']:
         result += "\n"
         scaledown_cmd_line = ['oc', 'scale', 'sts', resource_to_scaledown, '--replicas=0']
-        scaledown_cmd = subprocess.run(scaledown_cmd_line, capture_output=True)
+        scaledown_cmd = run_oc(scaledown_cmd_line, capture_output=True)
         if scaledown_cmd.returncode != 0:
             result += f"\nError {scaledown_cmd.returncode} while scaling down stateful set {resource_to_scaledown} to scale down\n"
         result += scaledown_cmd.stdout.decode().strip() + "\n"
         result += scaledown_cmd.stderr.decode().strip() + "\n"
 
-    result_cmd = subprocess.run(['oc', 'get', 'pod'], capture_output=True)
+    result_cmd = run_oc(['oc', 'get', 'pod'], capture_output=True)
     if result_cmd.returncode != 0:
         chat(ctx).send_text(f"Error while getting pod status", is_error=True)
     result += result_cmd.stdout.decode().strip() + "\n"
     result += result_cmd.stderr.decode().strip() + "\n"
 
 
-    logout_cmd = subprocess.run(['oc', 'logout', f'--server={server_url}'], capture_output=True)
+    logout_cmd = run_oc(['oc', 'logout', f'--server={server_url}'], capture_output=True)
     result += logout_cmd.stdout.decode().strip() + "\n"
     result += logout_cmd.stderr.decode().strip() + "\n"
 
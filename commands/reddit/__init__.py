@@ -17,6 +17,9 @@ from requests.structures import CaseInsensitiveDict
 from bot_framework.yaml_wrapper import yaml
 from commands import gyrobot, chat, subreddit, DefaultCommandGroup, reddit_session, logger, ClickAliasedGroup
 from commands.reddit.common import extract_username, extract_real_thread_id
+from commands.reddit.modmail_counts import modmail_counts
+from commands.reddit.modqueue_snapshot import modqueue_snapshot
+from file_lock import atomic_open, locked, yaml_lock
 from state_file import state_file
 
 ARCHIVE_URL = 'http://archive.is'
@@ -25,6 +28,8 @@ CHROME_USER_AGENT = (
     'AppleWebKit/537.36 (KHTML, like Gecko) '
     'Chrome/77.0.3865.90 Safari/537.36')
 
+CROWD_CONTROL_READ_ONLY_COMMANDS = ('list',)
+
 _archive_session = requests.Session()
 _archive_session.mount(ARCHIVE_URL, HTTPAdapter(max_retries=5))
 
@@ -83,9 +88,9 @@ def modqueue():
 def modqueue_posts(ctx):
     """Display posts from the modqueue"""
     text = ''
-    for s in subreddit(ctx).mod.modqueue(only='submissions'):
+    for s in modqueue_snapshot(subreddit(ctx)).submissions[:100]:
         text += s.title + '\n' + s.url + '\n'
-    else:
+    if not text:
         text = "No posts in modqueue"
     chat(ctx).send_text(text)
 
@@ -95,9 +100,9 @@ def modqueue_posts(ctx):
 def modqueue_comments(ctx):
     """Display comments from the modqueue"""
     text = ''
-    for c in subreddit(ctx).mod.modqueue(only='comments', limit=10):
+    for c in modqueue_snapshot(subreddit(ctx)).comments[:10]:
         text += reddit_session(ctx).config.reddit_url + c.permalink + '\n```\n' + c.body[:80] + '\n```\n'
-    else:
+    if not text:
         text = "No comments in modqueue"
     chat(ctx).send_text(text)
 
@@ -105,7 +110,7 @@ def modqueue_comments(ctx):
 @modqueue.command('grouped')
 @click.pass_context
 def modqueue_grouped(ctx):
-    modqueue_list = list(subreddit(ctx).mod.modqueue(limit=None))
+    modqueue_list = modqueue_snapshot(subreddit(ctx)).items
     if len(modqueue_list) < 1:
         chat(ctx).send_text('Modqueue is empty!', is_error=True)
         return
@@ -133,9 +138,12 @@ def modqueue_grouped(ctx):
 @click.pass_context
 def modqueue_length(ctx):
     """Show modqueue length"""
-    posts_modqueue_length = len(list(subreddit(ctx).mod.modqueue(only='submissions', limit=None)))
-    comments_modqueue_length = len(list(subreddit(ctx).mod.modqueue(only='comments', limit=None)))
-    modmail_open_length = len(list(subreddit(ctx).modmail.conversations(limit=1000)))
+    snapshot = modqueue_snapshot(subreddit(ctx))
+    posts_modqueue_length = len(snapshot.submissions)
+    comments_modqueue_length = len(snapshot.comments)
+    modmail_by_state = modmail_counts(subreddit(ctx))
+    modmail_open_length = sum(modmail_by_state.values())
+    modmail_states = ', '.join(f"{count} {state}" for state, count in modmail_by_state.items() if count)
     post_descr = 'posts' if posts_modqueue_length != 1 else 'post'
     comment_descr = 'comments' if comments_modqueue_length != 1 else 'comment'
     modmail_descr = 'modmails' if modmail_open_length != 1 else 'modmail'
@@ -146,7 +154,7 @@ def modqueue_length(ctx):
             default_team_creature = pref_cache.get('default', default_creature)
             creature = pref_cache.get(chat(ctx).user_id, default_team_creature)
         if modmail_open_length > 0:
-            creature += f"\nBut {modmail_open_length} {modmail_descr} remain"
+            creature += f"\nBut {modmail_open_length} {modmail_descr} remain ({modmail_states})"
         chat(ctx).send_text(creature)
     else:
         reddit_url = reddit_session(ctx).config.reddit_url
@@ -157,6 +165,8 @@ def modqueue_length(ctx):
         text = (f"Modqueue contains <{modqueue_posts_url}|{posts_modqueue_length} {post_descr}>, "
                 f"<{modqueue_comments_url}|{comments_modqueue_length} {comment_descr}> and "
                 f"{modmail_open_length} {modmail_descr}")
+        if modmail_open_length > 0:
+            text += f" ({modmail_states})"
         chat(ctx).send_text(text)
 
 
@@ -242,10 +252,7 @@ def add_domain_tag(ctx, url, color):
 @click.pass_context
 def add_policy(ctx, title):
     """Add a minor policy change done via Slack's #modpolicy channel"""
-    permalink_response = chat(ctx).web_client.chat_getPermalink(
-        channel=chat(ctx).channel_id,
-        message_ts=chat(ctx).message['ts'])
-    permalink = permalink_response['permalink']
+    permalink = chat(ctx).permalink['permalink']
     policy_subreddit = os.environ.get('REDDIT_POLICY_SUBREDDIT', subreddit(ctx).display_name)
     policy_page = os.environ.get('REDDIT_POLICY_PAGE', 'mod_policy_votes')
     sr = reddit_session(ctx).subreddit(policy_subreddit)
@@ -310,12 +317,12 @@ def archive_user(ctx, username):
         url = url_base + '&count=25&after=' + after
         urls_to_archive.append(url)
     chat(ctx).send_file(
-        file_data='\n'.join(urls_to_archive).encode(),
+        file_data=(f'{url}\n'.encode() for url in urls_to_archive),
         filename=f'archive-{user}-request.txt',
         filetype='text/plain')
-    final_urls = [_archive_page(url) for url in urls_to_archive]
+    # each response is spooled to the upload as soon as it arrives, instead of collecting them all first
     chat(ctx).send_file(
-        file_data='\n'.join(final_urls).encode(),
+        file_data=(f'{_archive_page(url)}\n'.encode() for url in urls_to_archive),
         filename=f'archive-{user}-response.txt',
         filetype='text/plain')
 
@@ -399,15 +406,19 @@ def configure_enhanced_crowd_control(ctx):
     """
     config = {}
     config_file = pathlib.Path(f'config/enhanced_crowd_control.yml')
+    # held until the subcommand is done, so that two changes (from workers or other bots) can't interleave
+    read_only = ctx.invoked_subcommand in CROWD_CONTROL_READ_ONLY_COMMANDS
+    ctx.with_resource(locked(config_file, exclusive=not read_only))
     if config_file.exists():
-        with config_file.open(mode='r', encoding='utf8') as y:
+        with config_file.open(mode='r', encoding='utf8') as y, yaml_lock:
             config = dict(yaml.load(y))
     if subreddit(ctx).display_name not in config:
         config[subreddit(ctx).display_name] = {
             'slack': {'channel': '#something', 'url': 'https://hooks.slack.com/services/TEAM_ID/CHANNEL_ID/KEY'},
             'threads': [{'action': 'remove', 'id': 'xxxxxx', 'last': None}]}
-        with config_file.open(mode='w', encoding='utf8') as y:
-            yaml.dump(config, y)
+        if not read_only:
+            with atomic_open(config_file) as y, yaml_lock:
+                yaml.dump(config, y)
     monitored_threads: list = config[subreddit(ctx).display_name]['threads']
     ctx.obj['monitored_threads'] = monitored_threads
     ctx.obj['config'] = config
@@ -473,7 +484,7 @@ def configure_enhanced_crowd_control_add(ctx, thread_id):
             'permalink': permalink})
         chat(ctx).send_text(f"Added {thread_id} ({submission_url})")
 
-    with ctx.obj['config_file'].open(mode='w', encoding='utf8') as y:
+    with atomic_open(ctx.obj['config_file']) as y, yaml_lock:
         yaml.dump(ctx.obj['config'], y)
 
 
@@ -498,5 +509,5 @@ def configure_enhanced_crowd_control_list(ctx, thread_id):
     else:
         chat(ctx).send_text(f"{thread_id} not found", is_error=True)
 
-    with ctx.obj['config_file'].open(mode='w', encoding='utf8') as y:
+    with atomic_open(ctx.obj['config_file']) as y, yaml_lock:
         yaml.dump(ctx.obj['config'], y)
@@ -0,0 +1,77 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+DEFAULT_TTL = 60.0
+DEFAULT_STATES = ('new', 'inprogress', 'mod', 'notifications')
+# unread: one call to the unread count endpoint; list: count the conversations (up to 1000), like before
+MODES = ('unread', 'list')
+
+logger = logging.getLogger(__name__)
+
+COUNTS = metrics.counter(
+    'slackbot_modmail_counts_total', 'Modmail counts served, by where they came from', ('subreddit', 'outcome'))
+FETCH_LATENCY = metrics.histogram('slackbot_modmail_count_seconds', 'Time spent counting modmail', ('mode',))
+
+
+class ModmailCounts:
+    """Modmail conversation counts per state, kept for `ttl` seconds.
+
+    In unread mode the counts come from Reddit's unread count endpoint, which covers every subreddit the
+    account moderates. Only one command at a time asks Reddit, the rest wait for its answer."""
+
+    def __init__(self, ttl=DEFAULT_TTL, mode='unread', states=DEFAULT_STATES):
+        if mode not in MODES:
+            raise ValueError(f"Modmail count mode should be one of {', '.join(MODES)}, not {mode}")
+        self.ttl = ttl
+        self.mode = mode
+        self.states = tuple(states)
+        self._counts = {}  # subreddit name -> (taken at, {state: count})
+        self._fetch_locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _fresh(self, name):
+        entry = self._counts.get(name)
+        if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+            return entry[1]
+        return None
+
+    def get(self, subreddit):
+        name = subreddit.display_name.lower()
+        counts = self._fresh(name)
+        if counts is not None:
+            COUNTS.inc(name, 'cached')
+            return counts
+        with self._lock:
+            fetch_lock = self._fetch_locks[name]
+        with fetch_lock:
+            counts = self._fresh(name)
+            if counts is not None:
+                COUNTS.inc(name, 'shared')
+                return counts
+            with FETCH_LATENCY.time(self.mode):
+                counts = self._fetch(subreddit)
+            self._counts[name] = (time.monotonic(), counts)
+            COUNTS.inc(name, 'fetched')
+            logger.debug(f"Modmail of r/{subreddit.display_name}: {counts}")
+            return counts
+
+    def _fetch(self, subreddit):
+        if self.mode == 'list':
+            return {'open': len(list(subreddit.modmail.conversations(limit=1000)))}
+        unread = subreddit.modmail.unread_count()
+        return {state: unread.get(state, 0) for state in self.states}
+
+
+counts = ModmailCounts(
+    float(os.environ.get('MODMAIL_COUNT_TTL', DEFAULT_TTL)),
+    os.environ.get('MODMAIL_COUNT_MODE', 'unread'),
+    os.environ['MODMAIL_COUNT_STATES'].split(',') if 'MODMAIL_COUNT_STATES' in os.environ else DEFAULT_STATES)
+
+
+def modmail_counts(subreddit):
+    return counts.get(subreddit)
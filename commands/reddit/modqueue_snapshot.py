@@ -0,0 +1,89 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+DEFAULT_TTL = 5.0
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOTS = metrics.counter(
+    'slackbot_modqueue_snapshots_total', 'Modqueue snapshots served, by where they came from', ('subreddit', 'outcome'))
+FETCH_LATENCY = metrics.histogram('slackbot_modqueue_fetch_seconds', 'Time spent listing the whole modqueue',
+                                  ('subreddit',))
+
+
+class ModqueueSnapshot:
+    """The items of a modqueue at one point in time, split into submissions (t3_) and comments (t1_)"""
+
+    def __init__(self, items, taken_at=None, ttl=None):
+        self.items = list(items)
+        self.taken_at = time.monotonic() if taken_at is None else taken_at
+        self.ttl = ttl  # None keeps it for the TTL of ModqueueSnapshots
+        self.submissions = []
+        self.comments = []
+        for item in self.items:
+            kind = item.fullname[:3]
+            if kind == 't3_':
+                self.submissions.append(item)
+            elif kind == 't1_':
+                self.comments.append(item)
+
+    def __len__(self):
+        return len(self.items)
+
+    def age(self):
+        return time.monotonic() - self.taken_at
+
+
+class ModqueueSnapshots:
+    """The latest modqueue snapshot of each subreddit, kept for `ttl` seconds.
+
+    When several commands need the modqueue at once, one of them lists it and the rest wait for that listing."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._snapshots = {}
+        self._fetch_locks = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _fresh(self, name):
+        snapshot = self._snapshots.get(name)
+        if snapshot is not None and snapshot.age() <= (self.ttl if snapshot.ttl is None else snapshot.ttl):
+            return snapshot
+        return None
+
+    def get(self, subreddit):
+        name = subreddit.display_name.lower()
+        snapshot = self._fresh(name)
+        if snapshot is not None:
+            SNAPSHOTS.inc(name, 'cached')
+            return snapshot
+        with self._lock:
+            fetch_lock = self._fetch_locks[name]
+        with fetch_lock:
+            snapshot = self._fresh(name)
+            if snapshot is not None:
+                # listed by another command while this one was waiting
+                SNAPSHOTS.inc(name, 'shared')
+                return snapshot
+            with FETCH_LATENCY.time(name):
+                snapshot = ModqueueSnapshot(subreddit.mod.modqueue(limit=None))
+            self._snapshots[name] = snapshot
+            SNAPSHOTS.inc(name, 'fetched')
+            logger.debug(f"Listed {len(snapshot)} modqueue items of r/{subreddit.display_name}")
+            return snapshot
+
+    def put(self, subreddit_name, snapshot):
+        """Use a snapshot made elsewhere (by the modqueue poller) instead of listing the modqueue"""
+        self._snapshots[subreddit_name.lower()] = snapshot
+
+
+snapshots = ModqueueSnapshots(float(os.environ.get('MODQUEUE_SNAPSHOT_TTL', DEFAULT_TTL)))
+
+
+def modqueue_snapshot(subreddit):
+    return snapshots.get(subreddit)
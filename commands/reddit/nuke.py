@@ -5,7 +5,7 @@ import prawcore
 
 from commands import gyrobot, reddit_session, chat, bot_reddit_session, logger, subreddit
 from commands.reddit.common import extract_real_thread_id, extract_username
-from state_file import state_file
+from commands.reddit.nuke_journal import journal_for_current_log_name
 
 
 @gyrobot.group('nuke')
@@ -42,8 +42,7 @@ def nuke_thread(ctx, thread_id):
         f"{comments_distinguished} distinguished comments were kept.\n"
         f"{comments_already_removed} comments were already removed.\n"
         "Submission was locked")
-    with state_file('nuke_thread') as state:
-        state[thread_id] = comments_removed
+    journal_for_current_log_name().record(thread_id, comments_removed)
     chat(ctx).send_text(result)
 
 
@@ -54,15 +53,17 @@ def undo_nuke_thread(ctx, thread_id):
     """Undo previous nuke thread
     Thread ID should be either the submission URL or the submission id"""
     thread_id = extract_real_thread_id(thread_id)
-    with state_file('nuke_thread') as state:
-        if thread_id not in state:
-            chat(ctx).send_text(f"Could not find thread {thread_id}", is_error=True)
-            return
-        removed_comments = state.pop(thread_id)
-        for comment_id in removed_comments:
-            comment = reddit_session(ctx).comment(comment_id)
-            comment.mod.approve()
-        chat(ctx).send_text(f"Nuking {len(removed_comments)} comments was undone")
+    journal = journal_for_current_log_name()
+    removed_comments = journal.lookup(thread_id)
+    if removed_comments is None:
+        chat(ctx).send_text(f"Could not find thread {thread_id}", is_error=True)
+        return
+    for comment_id in removed_comments:
+        comment = reddit_session(ctx).comment(comment_id)
+        comment.mod.approve()
+    # only forget the thread once every comment is back, so that a failed undo can be retried
+    journal.pop(thread_id)
+    chat(ctx).send_text(f"Nuking {len(removed_comments)} comments was undone")
 
 
 CUTOFF_AGES = {'24': 1, '48': 2, '72': 3, 'A_WEEK': 7, 'TWO_WEEKS': 14, 'A_MONTH': 30, 'THREE_MONTHS': 90,
@@ -0,0 +1,169 @@
+import logging
+import os
+import pathlib
+import threading
+import time
+
+import state_file
+from file_lock import atomic_open, locked
+
+DEFAULT_RETENTION_DAYS = 90
+# compact when more than half of the file is undone, expired or superseded records
+COMPACT_DEAD_RATIO = 0.5
+COMPACT_MIN_BYTES = 64 * 1024
+
+OP_NUKE = 'N'
+OP_UNDO = 'U'
+
+logger = logging.getLogger(__name__)
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+
+def format_record(op, thread_id, timestamp, comment_ids):
+    # reddit ids are already base36, joining them with commas is the compact form
+    return f"{op}\t{thread_id}\t{int(timestamp)}\t{','.join(comment_ids)}\n"
+
+
+def parse_record(line):
+    op, thread_id, timestamp, packed_ids = line.decode('utf8').rstrip('\n').split('\t')
+    return op, thread_id, int(timestamp), packed_ids.split(',') if packed_ids else []
+
+
+class NukeJournal:
+    """Append-only journal of the comments removed by `nuke thread`, so that `nuke thread_undo` can approve them.
+
+    Every nuke appends a record and every undo appends a tombstone. An in-memory index maps each thread to the
+    offset of its live record, so a lookup is one seek and one line. Records older than the retention period, and
+    the ones undone, are dropped when the file is compacted."""
+
+    def __init__(self, path, retention_days=DEFAULT_RETENTION_DAYS):
+        self.path = pathlib.Path(path)
+        self.retention = retention_days * 24 * 60 * 60
+        self._lock = threading.Lock()
+        self._index = {}  # thread id -> (offset, timestamp)
+        self._scanned_to = 0
+        self._inode = None
+        self._dead_bytes = 0
+        self.path.touch(exist_ok=True)
+        with locked(self.path, exclusive=False):
+            self._rescan()
+        self._compact_if_needed()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, thread_id):
+        return self.lookup(thread_id) is not None
+
+    def _rescan(self):
+        self._index = {}
+        self._scanned_to = 0
+        self._dead_bytes = 0
+        self._inode = os.stat(self.path).st_ino
+        self._scan_tail()
+
+    def _scan_tail(self):
+        """Index the records appended since the last scan (maybe by another process)"""
+        with self.path.open(mode='rb') as f:
+            f.seek(self._scanned_to)
+            offset = self._scanned_to
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break  # another process is still writing this record
+                op, thread_id, timestamp, _ = parse_record(line)
+                previous = self._index.pop(thread_id, None)
+                if previous is not None:
+                    self._dead_bytes += self._record_length(previous[0])
+                if op == OP_NUKE:
+                    self._index[thread_id] = (offset, timestamp)
+                else:
+                    self._dead_bytes += len(line)
+                offset += len(line)
+            self._scanned_to = offset
+
+    def _record_length(self, offset):
+        with self.path.open(mode='rb') as f:
+            f.seek(offset)
+            return len(f.readline())
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        if stat.st_ino != self._inode:
+            self._rescan()  # compacted by another process
+        elif stat.st_size != self._scanned_to:
+            self._scan_tail()
+
+    def _append(self, op, thread_id, comment_ids):
+        with locked(self.path, exclusive=True), self._lock:
+            self._refresh()
+            record = format_record(op, thread_id, time.time(), comment_ids)
+            with self.path.open(mode='a', encoding='utf8') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self._scan_tail()
+
+    def record(self, thread_id, comment_ids):
+        self._append(OP_NUKE, thread_id, comment_ids)
+        self._compact_if_needed()
+
+    def lookup(self, thread_id):
+        """The comment ids removed from the thread, or None if it wasn't nuked (or was undone or expired)"""
+        with locked(self.path, exclusive=False), self._lock:
+            self._refresh()
+            entry = self._index.get(thread_id)
+            if entry is None or time.time() - entry[1] > self.retention:
+                return None
+            with self.path.open(mode='rb') as f:
+                f.seek(entry[0])
+                return parse_record(f.readline())[3]
+
+    def pop(self, thread_id):
+        comment_ids = self.lookup(thread_id)
+        if comment_ids is not None:
+            self._append(OP_UNDO, thread_id, [])
+        return comment_ids
+
+    def _compact_if_needed(self):
+        size = os.stat(self.path).st_size
+        now = time.time()
+        expired = any(now - timestamp > self.retention for _, timestamp in list(self._index.values()))
+        if expired or (size > COMPACT_MIN_BYTES and self._dead_bytes > size * COMPACT_DEAD_RATIO):
+            self.compact()
+
+    def compact(self):
+        """Rewrite the journal with only the live records that are within the retention period"""
+        with locked(self.path, exclusive=True), self._lock:
+            self._refresh()
+            now = time.time()
+            size_before = os.stat(self.path).st_size
+            live = sorted((offset, thread_id) for thread_id, (offset, timestamp) in self._index.items()
+                          if now - timestamp <= self.retention)
+            with self.path.open(mode='rb') as source, atomic_open(self.path) as target:
+                for offset, thread_id in live:
+                    source.seek(offset)
+                    target.write(source.readline().decode('utf8'))
+            self._rescan()
+        logger.info(f"Compacted {self.path} from {size_before} to {os.stat(self.path).st_size} bytes, "
+                    f"{len(self._index)} threads kept")
+
+
+def migrate_state_file(journal):
+    """Move the threads kept by the previous version (state_file('nuke_thread')) into the journal"""
+    with state_file.state_file('nuke_thread') as state:
+        for thread_id in list(state):
+            journal.record(thread_id, state.pop(thread_id))
+            logger.info(f"Moved the nuke of {thread_id} to {journal.path}")
+
+
+def journal_for_current_log_name():
+    log_name = state_file.log_name()
+    with _journals_lock:
+        if log_name not in _journals:
+            retention_days = int(os.environ.get('NUKE_JOURNAL_RETENTION_DAYS', DEFAULT_RETENTION_DAYS))
+            journal = NukeJournal(f'{state_file.DATA_DIRECTORY}/nuke_journal-{log_name}.log', retention_days)
+            migrate_state_file(journal)
+            _journals[log_name] = journal
+        return _journals[log_name]
@@ -11,6 +11,8 @@ from tabulate import tabulate
 
 from bot_framework.yaml_wrapper import yaml
 from commands import gyrobot, chat
+from file_lock import yaml_lock
+from metrics import timed
 
 SQL_SURVEY_PREFILLED_ANSWERS = """select answer[3] AS Code, answer_value as Answer, count(*) AS VoteCount
 from (select regexp_split_to_array(code, '_') AS answer_parts, *
@@ -79,9 +81,11 @@ def _survey_question(self, questions, question_id):
 
 def _survey_database_query(sql):
     database_url = os.environ['QUESTIONNAIRE_DATABASE_URL']
-    conn = psycopg2.connect(database_url)
+    with timed('postgres', 'connect'):
+        conn = psycopg2.connect(database_url)
     cur = conn.cursor()
-    cur.execute(sql)
+    with timed('postgres', 'query'):
+        cur.execute(sql)
     rows = cur.fetchall()
     cols = [col.name for col in cur.description]
     cur.close()
@@ -131,7 +135,7 @@ def survey(ctx):
     if not questionnaire_file.exists():
         chat(ctx).send_text('No questionnaire file found', is_error=True)
         return
-    with questionnaire_file.open(encoding='utf8') as qf:
+    with questionnaire_file.open(encoding='utf8') as qf, yaml_lock:
         questionnaire_data = list(yaml.load_all(qf))
     questions = [q for q in questionnaire_data if q['kind'] not in ('config', 'header')]
     question_ids = [f'q_{1 + i}' for i in range(len(questions))]
@@ -183,7 +187,6 @@ def survey(ctx):
         table = _make_table(title, cols, rows)
         chat(ctx).send_file(table, title=title, filetype='markdown')
     elif result_type == 'full_table':
-        filedata = b''
         with tempfile.TemporaryFile() as tmpfile:
             workbook = xlsxwriter.Workbook(tmpfile)
             for question_response in result:
@@ -204,8 +207,7 @@ def survey(ctx):
             workbook.close()
             tmpfile.flush()
             tmpfile.seek(0, io.SEEK_SET)
-            filedata = tmpfile.read()
-        chat(ctx).send_file(filedata, filename="Survey_Results.xlsx", title="Survey Results", filetype='xlsx')
+            chat(ctx).send_file(tmpfile, filename="Survey_Results.xlsx", title="Survey Results", filetype='xlsx')
     elif result_type == 'full_table_json':
         filedata = json.dumps(result)
         chat(ctx).send_file(filedata, filename='Survey_Results.json', title="Survey Results", filetype="json")
@@ -0,0 +1,119 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+DEFAULT_WINDOW = 15 * 60
+DEFAULT_MAX_SIZE = 50000
+SAVE_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+EVENTS_CHECKED = metrics.counter(
+    'slackbot_dedup_events_total', 'Events checked for redelivery, by outcome', ('source', 'outcome'))
+
+
+def event_keys(event, prefix=''):
+    """The keys an event can be recognised by: the Events API event_id, the client_msg_id of a message,
+    and its (channel, ts), which stays the same when a message is edited"""
+    keys = []
+    if event.get('event_id'):
+        keys.append(f"{prefix}event:{event['event_id']}")
+    if event.get('client_msg_id'):
+        keys.append(f"{prefix}client_msg:{event['client_msg_id']}")
+    if event.get('channel') and event.get('ts'):
+        keys.append(f"{prefix}ts:{event['channel']}:{event['ts']}")
+    return keys
+
+
+class EventDeduplicator:
+    """Remembers the events seen in the last `window` seconds (at most `max_size` keys), so that redelivered or
+    edited events don't run twice. With a `path`, the window is saved there and survives restarts.
+
+    is_duplicate saves the window every SAVE_INTERVAL seconds itself, unless `autosave` is off: an event loop
+    should call save() in an executor when save_due() says so, rather than write the file in a handler."""
+
+    def __init__(self, window=DEFAULT_WINDOW, max_size=DEFAULT_MAX_SIZE, path=None, autosave=True):
+        self.window = window
+        self.max_size = max_size
+        self.path = path
+        self.autosave = autosave
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # saves may run in several executor threads, they share the .tmp file
+        self._dirty = False
+        self._next_save = time.monotonic() + SAVE_INTERVAL
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at <= self.window and len(self._seen) <= self.max_size:
+                break
+            self._seen.popitem(last=False)
+
+    def is_duplicate(self, keys, source='unknown'):
+        """True if any of the keys was seen within the window, otherwise remember them all and return False"""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            duplicate = any(key in self._seen for key in keys)
+            if not duplicate:
+                for key in keys:
+                    self._seen[key] = now
+                self._expire(now)
+                self._dirty = True
+        EVENTS_CHECKED.inc(source, 'duplicate' if duplicate else 'new')
+        if self.autosave and self.save_due():
+            self.save()
+        return duplicate
+
+    def forget(self, keys):
+        """Undo is_duplicate for an event that couldn't be handled, so that its redelivery is"""
+        with self._lock:
+            for key in keys:
+                self._seen.pop(key, None)
+            self._dirty = True
+
+    def save_due(self):
+        return bool(self.path) and self._dirty and time.monotonic() >= self._next_save
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logger.exception(f'Could not read {self.path}, starting with an empty window')
+            return
+        now = time.time()
+        with self._lock:
+            for key, seen_at in sorted(saved.items(), key=lambda item: item[1]):
+                if now - seen_at <= self.window:
+                    self._seen[key] = seen_at
+            self._expire(now)
+        logger.debug(f'Loaded {len(self._seen)} recent events from {self.path}')
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                self._expire(time.time())
+                snapshot = dict(self._seen)
+                self._dirty = False
+                self._next_save = time.monotonic() + SAVE_INTERVAL
+            temporary_path = f'{self.path}.tmp'
+            try:
+                with open(temporary_path, 'w', encoding='utf8') as f:
+                    json.dump(snapshot, f)
+                os.replace(temporary_path, self.path)
+            except OSError:
+                logger.exception(f'Could not save the recent events to {self.path}')
@@ -0,0 +1,89 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+DEFAULT_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT = metrics.histogram('slackbot_dispatcher_queue_wait_seconds', 'Time a job waited before a worker started it')
+
+
+class Dispatcher:
+    """Run jobs on a bounded worker pool.
+
+    Jobs for the same channel run one after the other, in the order they were
+    submitted. Jobs for different channels run in parallel. With zero workers,
+    jobs run inline on the calling thread."""
+
+    def __init__(self, handler, max_workers=DEFAULT_WORKERS):
+        self.handler = handler
+        self.max_workers = max_workers
+        self._executor = None
+        if max_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='dispatcher')
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._busy = 0
+
+    def submit(self, channel_id, *args):
+        if self._executor is None:
+            self._run(time.perf_counter(), args)
+            return
+        with self._lock:
+            channel_queue = self._pending.setdefault(channel_id, collections.deque())
+            channel_queue.append((time.perf_counter(), args))
+            start_worker = len(channel_queue) == 1
+        if start_worker:
+            self._executor.submit(self._drain, channel_id)
+
+    def _drain(self, channel_id):
+        with self._lock:
+            channel_queue = self._pending[channel_id]
+        while True:
+            with self._lock:
+                enqueued_at, args = channel_queue[0]
+            # noinspection PyBroadException
+            try:
+                self._run(enqueued_at, args)
+            except BaseException:
+                # e.g. SystemExit: it ends this job, the channel's next jobs still have to run
+                logger.exception('Dispatched job exited')
+            with self._lock:
+                channel_queue.popleft()
+                if not channel_queue:
+                    del self._pending[channel_id]
+                    return
+
+    def _run(self, enqueued_at, args):
+        QUEUE_WAIT.observe(time.perf_counter() - enqueued_at)
+        with self._lock:
+            self._busy += 1
+        # noinspection PyBroadException
+        try:
+            self.handler(*args)
+        except Exception:
+            logger.exception('Unhandled error in dispatched job')
+        finally:
+            with self._lock:
+                self._busy -= 1
+
+    def stats(self):
+        with self._lock:
+            queued = sum(len(q) for q in self._pending.values())
+            busy = self._busy
+            active_channels = len(self._pending)
+        return {
+            'queue_depth': max(queued - busy, 0),
+            'busy_workers': busy,
+            'max_workers': self.max_workers,
+            'active_channels': active_channels,
+            'saturation': busy / self.max_workers if self.max_workers else 0.0}
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
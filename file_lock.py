@@ -0,0 +1,48 @@
+import os
+import pathlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, no advisory locks
+    fcntl = None
+
+# bot_framework.yaml_wrapper.yaml is one ruamel YAML instance for the whole process, and YAML instances keep
+# their parser state on themselves: commands running in parallel workers take this around load and dump
+yaml_lock = threading.Lock()
+
+
+@contextmanager
+def locked(path, exclusive=True):
+    """Advisory lock on a sidecar <path>.lock file: shared for readers, exclusive for writers.
+
+    The lock is taken on a fresh open file, so it works between threads as well as between processes."""
+    if fcntl is None:
+        yield
+        return
+    lock_path = pathlib.Path(path).with_name(pathlib.Path(path).name + '.lock')
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_open(path, encoding='utf8'):
+    """Open a temporary file next to `path` for writing, and rename it over `path` once the block succeeds.
+
+    Readers see either the old or the new content, never a truncated file."""
+    path = pathlib.Path(path)
+    temporary_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(temporary_path, 'w', encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
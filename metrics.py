@@ -0,0 +1,217 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per bucket counts (the last one is +Inf), sum of observations
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            series = [(label_values, list(counts), total) for label_values, (counts, total) in self._series.items()]
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield self.name + '_bucket', _format_labels(self.label_names, label_values, [('le', le)]), cumulative
+            yield self.name + '_sum', _format_labels(self.label_names, label_values), total
+            yield self.name + '_count', _format_labels(self.label_names, label_values), cumulative
+
+
+class CallbackMetric:
+    """Metric whose values are read when scraped, `function` returns {label values tuple: value}"""
+
+    def __init__(self, name, documentation, kind, label_names, function):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.function = function
+
+    def samples(self):
+        for label_values, value in self.function().items():
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            # noinspection PyBroadException
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f'{name}{labels} {value}')
+            except Exception:
+                logger.exception(f'Could not collect {metric.name}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, label_names=()):
+    return REGISTRY.register(Counter(name, documentation, label_names))
+
+
+def histogram(name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+
+def callback(name, documentation, kind, label_names, function):
+    return REGISTRY.register(CallbackMetric(name, documentation, kind, label_names, function))
+
+
+UPSTREAM_CALLS = counter(
+    'slackbot_upstream_calls_total', 'Calls made to upstream services', ('upstream', 'operation', 'outcome'))
+UPSTREAM_LATENCY = histogram(
+    'slackbot_upstream_call_seconds', 'Duration of calls made to upstream services', ('upstream', 'operation'))
+
+
+@contextmanager
+def timed(upstream, operation):
+    """Count and time one call to an upstream service (Slack, Reddit, PostgreSQL, oc...)"""
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream, operation)
+        UPSTREAM_CALLS.inc(upstream, operation, outcome)
+
+
+class InstrumentedClient:
+    """Wraps an API client (e.g. slack.WebClient) so that every method call goes through timed()"""
+
+    def __init__(self, client, upstream):
+        self._client = client
+        self._upstream = upstream
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def instrumented_call(*args, **kwargs):
+            with timed(self._upstream, name):
+                return attribute(*args, **kwargs)
+
+        return instrumented_call
+
+
+def instrument_requests_session(session, upstream):
+    """Count and time the responses of a requests.Session (e.g. the one inside a praw session)"""
+
+    def record_response(response, *args, **kwargs):
+        outcome = 'ok' if response.ok else str(response.status_code)
+        UPSTREAM_LATENCY.observe(response.elapsed.total_seconds(), upstream, response.request.method)
+        UPSTREAM_CALLS.inc(upstream, response.request.method, outcome)
+
+    session.hooks['response'].append(record_response)
+
+
+def instrument_reddit(reddit):
+    # praw doesn't expose its requests.Session, it lives in the prawcore requestor
+    session = getattr(getattr(getattr(reddit, '_core', None), '_requestor', None), '_http', None)
+    if session is not None:
+        instrument_requests_session(session, 'reddit')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_http_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
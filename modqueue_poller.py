@@ -0,0 +1,131 @@
+import collections
+import logging
+import threading
+import time
+
+import metrics
+from commands.reddit.modqueue_snapshot import ModqueueSnapshot, snapshots
+
+DEFAULT_POLL_INTERVAL = 60
+# incremental polls don't see items that left the queue, a full listing every so often does
+DEFAULT_RESYNC_INTERVAL = 5 * 60
+DEFAULT_ALERT_LENGTH = 100
+DEFAULT_ALERT_AGE = 6 * 60 * 60
+
+POLLS = metrics.counter('slackbot_modqueue_polls_total', 'Modqueue polls: incremental, full or error',
+                        ('subreddit', 'kind'))
+
+
+class ModqueuePoller:
+    """Keeps the modqueue of a subreddit in memory, and calls `alert` when it gets too long or too old.
+
+    The modqueue is listed newest first, so a poll only pages until it reaches an item it already knows.
+    Such a poll can't see the items that were handled since, so only full listings are handed to the modqueue
+    commands, and alerts are raised and cleared on full listings."""
+
+    def __init__(self, subreddit, alert=None, interval=DEFAULT_POLL_INTERVAL,
+                 resync_interval=DEFAULT_RESYNC_INTERVAL, alert_length=DEFAULT_ALERT_LENGTH,
+                 alert_age=DEFAULT_ALERT_AGE, logger=None):
+        self.subreddit = subreddit
+        self.alert = alert
+        self.interval = interval
+        self.resync_interval = resync_interval
+        self.alert_length = alert_length
+        self.alert_age = alert_age
+        self.logger = logger or logging.getLogger(__name__)
+        self.items = collections.OrderedDict()  # fullname -> item, newest first
+        self._next_resync = 0.0
+        self._alerting = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def oldest_age(self):
+        items = list(self.items.values())
+        if not items:
+            return 0.0
+        return time.time() - min(item.created_utc for item in items)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f'modqueue-{self.subreddit.display_name}',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        while not self._stop.is_set():
+            # noinspection PyBroadException
+            try:
+                # while an alert is on every poll is a full one, so that "back to normal" isn't held up until
+                # the next resync. A new alert is confirmed with a full listing as well.
+                full = self.poll(full=bool(self._alerting))
+                if not full and self._crossed() - self._alerting:
+                    self.poll(full=True)
+                self.check_thresholds()
+            except Exception:
+                POLLS.inc(self.subreddit.display_name.lower(), 'error')
+                self.logger.exception(f"Could not poll the modqueue of r/{self.subreddit.display_name}")
+            self._stop.wait(self.interval)
+
+    def poll(self, full=False):
+        """Update the queued items, returns whether this was a full listing"""
+        subreddit_name = self.subreddit.display_name.lower()
+        full = full or time.monotonic() >= self._next_resync
+        new_items = []
+        reached_known = False
+        for item in self.subreddit.mod.modqueue(limit=None):
+            if not full and item.fullname in self.items:
+                reached_known = True
+                break
+            new_items.append(item)
+        self.logger.debug(f"{len(new_items)} new modqueue items in r/{self.subreddit.display_name}")
+        if reached_known:
+            self.items = collections.OrderedDict(
+                [(item.fullname, item) for item in new_items] + list(self.items.items()))
+            POLLS.inc(subreddit_name, 'incremental')
+            return False
+        # either a resync, or none of the known items is still queued: the listing is the whole queue
+        self.items = collections.OrderedDict((item.fullname, item) for item in new_items)
+        self._next_resync = time.monotonic() + self.resync_interval
+        POLLS.inc(subreddit_name, 'full')
+        # the commands may use it until the next poll
+        snapshots.put(subreddit_name, ModqueueSnapshot(self.items.values(), ttl=self.interval))
+        return True
+
+    def _crossed(self):
+        crossed = set()
+        if len(self.items) >= self.alert_length:
+            crossed.add('length')
+        if self.oldest_age() >= self.alert_age:
+            crossed.add('age')
+        return crossed
+
+    def check_thresholds(self):
+        length = len(self.items)
+        oldest_age = self.oldest_age()
+        crossed = self._crossed()
+        self._check('length', 'length' in crossed,
+                    f"The modqueue of r/{self.subreddit.display_name} has {length} items")
+        self._check('age', 'age' in crossed,
+                    f"The oldest item in the modqueue of r/{self.subreddit.display_name} "
+                    f"has been waiting for {oldest_age / 60:.0f} minutes")
+
+    def _check(self, threshold, crossed, text):
+        # alert once when a threshold is crossed, and once when the queue is back under it
+        if crossed and threshold not in self._alerting:
+            self._alerting.add(threshold)
+            self._send_alert(f":rotating_light: {text}")
+        elif not crossed and threshold in self._alerting:
+            self._alerting.discard(threshold)
+            self._send_alert(f":white_check_mark: Back to normal: {text}")
+
+    def _send_alert(self, text):
+        self.logger.info(text)
+        if self.alert is not None:
+            self.alert(text)
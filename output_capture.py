@@ -0,0 +1,95 @@
+import contextvars
+import io
+import sys
+from contextlib import contextmanager
+
+CHUNK_SIZE = 3000
+
+_current_sink = contextvars.ContextVar('output_sink', default=None)
+
+
+class OutputSink(io.TextIOBase):
+    """Collects text written by one command and passes it to `send` in chunks of whole lines"""
+
+    def __init__(self, send, chunk_size=CHUNK_SIZE):
+        super().__init__()
+        self._send = send
+        self._chunk_size = chunk_size
+        self._parts = []
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            # like StringIO: click tells text streams from binary ones by writing b'' to them
+            raise TypeError(f'string argument expected, got {type(text).__name__!r}')
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self._chunk_size:
+            self._send_chunks()
+        return len(text)
+
+    def _send_chunks(self):
+        pending = ''.join(self._parts)
+        while len(pending) >= self._chunk_size:
+            cut = pending.rfind('\n', 0, self._chunk_size)
+            cut = cut + 1 if cut > 0 else self._chunk_size
+            self._emit(pending[:cut])
+            pending = pending[cut:]
+        self._parts = [pending]
+        self._size = len(pending)
+
+    def _emit(self, text):
+        # sent as written, leading spaces are the indentation of tables and tracebacks
+        if text.strip():
+            self._send(text)
+
+    def drain(self):
+        pending = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._emit(pending.rstrip('\n'))
+
+
+class _OutputRouter(io.TextIOBase):
+    """Stand-in for sys.stdout/sys.stderr that writes to the sink of the current context, if any"""
+
+    def __init__(self, fallback):
+        super().__init__()
+        self._fallback = fallback
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        sink = _current_sink.get()
+        if sink is None:
+            return self._fallback.write(text)
+        return sink.write(text)
+
+    def flush(self):
+        if _current_sink.get() is None:
+            self._fallback.flush()
+
+
+def install():
+    """Route sys.stdout and sys.stderr through the capture sinks. Returns the original streams."""
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    if not isinstance(real_stdout, _OutputRouter):
+        sys.stdout = _OutputRouter(real_stdout)
+    if not isinstance(real_stderr, _OutputRouter):
+        sys.stderr = _OutputRouter(real_stderr)
+    return real_stdout, real_stderr
+
+
+@contextmanager
+def capture_output(send, chunk_size=CHUNK_SIZE):
+    sink = OutputSink(send, chunk_size)
+    token = _current_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _current_sink.reset(token)
+        sink.drain()
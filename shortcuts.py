@@ -0,0 +1,96 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from bot_framework.common import normalize_text
+from bot_framework.yaml_wrapper import yaml
+
+RELOAD_CHECK_INTERVAL = 2.0
+
+logger = logging.getLogger(__name__)
+
+Expansion = collections.namedtuple('Expansion', 'first_word prefix lines')
+
+
+def compile_shortcuts(shortcut_words):
+    """Validate the shortcut definitions and pre-split them into an expansion table.
+
+    A shortcut is either a list of words (the first word of the message is replaced by them) or a list of lists of
+    words (the message is replaced by several command lines)."""
+    expansions = {}
+    for shortcut, replaced_words in shortcut_words.items():
+        if not isinstance(replaced_words, list) or not replaced_words:
+            logger.critical(f'Bad format for shortcut {shortcut}')
+        elif all(type(w) is str for w in replaced_words):
+            expansions[shortcut] = Expansion(replaced_words[0], ' '.join(replaced_words), None)
+        elif all(type(w) is list and w and all(type(ww) is str for ww in w) for w in replaced_words):
+            lines = tuple(' '.join(replaced_words_line) for replaced_words_line in replaced_words)
+            expansions[shortcut] = Expansion(replaced_words[0][0], None, lines)
+        else:
+            logger.critical(f'Bad format for shortcut {shortcut}')
+    return expansions
+
+
+class ShortcutIndex:
+    """Trigger words and shortcut expansions, compiled once and rebuilt when the shortcuts file changes"""
+
+    def __init__(self, trigger_words, path=None):
+        self.trigger_words = frozenset(trigger_words)
+        self.path = path
+        self._expansions = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        if path:
+            self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding='utf8') as sf:
+            shortcut_words = dict(yaml.load(sf) or {})
+        # swap the whole table at once, so readers see either the old or the new one
+        self._expansions = compile_shortcuts(shortcut_words)
+        self._mtime = mtime
+        logger.debug(f"Loaded {len(self._expansions)} shortcuts from {self.path}")
+
+    def _check_for_changes(self):
+        now = time.monotonic()
+        if not self.path or now < self._next_check:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_check = now + RELOAD_CHECK_INTERVAL
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                return
+            if mtime != self._mtime:
+                # noinspection PyBroadException
+                try:
+                    self.reload()
+                except Exception:
+                    logger.exception(f'Could not reload shortcuts from {self.path}, keeping the previous ones')
+        finally:
+            self._reload_lock.release()
+
+    def match(self, text):
+        """Return the command lines for a message, or an empty list if it is not meant for the bot"""
+        self._check_for_changes()
+        words = text.split()
+        if not words:
+            return []
+        first_word = normalize_text(words[0]).strip().lower()
+        text_lines = [text]
+        expansion = self._expansions.get(first_word)
+        if expansion is not None:
+            first_word = expansion.first_word
+            if expansion.lines is None:
+                text_lines = [expansion.prefix + ' ' + ' '.join(words[1:])]
+            else:
+                text_lines = list(expansion.lines)
+        if first_word not in self.trigger_words:
+            return []
+        return text_lines
@@ -1,137 +1,398 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import io
+import asyncio
 import locale
 import logging
 import os
+import signal
 import string
 import sys
+import threading
+import time
 import traceback
 from typing import TextIO
 
-import praw
+import click
 import requests
 import slack
 
 import commands
-import commands.generic
-from bot_framework.common import normalize_text
+import metrics
 from bot_framework.common import setup_logging
 from bot_framework.praw_wrapper import praw_wrapper
 from bot_framework.yaml_wrapper import yaml
+from chat.directory import DEFAULT_MAX_SIZE as DEFAULT_DIRECTORY_MAX_SIZE, DEFAULT_TTL as DEFAULT_DIRECTORY_TTL
+from chat.outbound import OutboundQueue, PRIORITY_NORMAL
 from chat.slack import SlackWrapper
+from dedup import EventDeduplicator, event_keys, DEFAULT_WINDOW as DEFAULT_DEDUP_WINDOW, SAVE_INTERVAL
+from dispatcher import Dispatcher, DEFAULT_WORKERS
+from output_capture import capture_output, install as install_output_capture
+from shortcuts import ShortcutIndex
+from state_file import current_log_name
 
-locale.setlocale(locale.LC_ALL, os.environ.get('LOCALE', ''))
-
-if 'MOCK_CONFIGURATION' in os.environ:
-    import commands.openshift.mock
-
-if 'DOCKER_DEPLOY_CONFIGURATION' in os.environ:
-    import commands.openshift.docker_deploy
-
-if 'OPENSHIFT_ACTUATOR_REFRESH' in os.environ:
-    import commands.openshift.refresh_actuator
-
-if 'OPENSHIFT_SCALEDOWN' in os.environ:
-    import commands.openshift.scaledown
-
-if 'OPENSHIFT_DEPLOYMENT' in os.environ:
-    import commands.openshift.deployment
+# startup timing is measured from here, close enough to the start of the process without asking psutil
+PROCESS_STARTED = time.time()
 
-if 'CHEESE_DATABASE_URL' in os.environ:
-    import commands.cheese
-
-if 'SUBREDDIT_NAME' in os.environ:
-    import commands.reddit
-    import commands.reddit.nuke
-
-if 'REDDIT_ALT_USER' in os.environ:
-    import commands.reddit.bot
-
-if 'QUESTIONNAIRE_DATABASE_URL' in os.environ and 'QUESTIONNAIRE_FILE' in os.environ:
-    import commands.reddit.survey
+locale.setlocale(locale.LC_ALL, os.environ.get('LOCALE', ''))
 
-if 'KUDOS_DATABASE_URL' in os.environ:
-    import commands.kudos
+# (required environment variables, module, [(command, aliases, short help)])
+# The modules are imported on first use, listing the commands here keeps startup (and help) cheap.
+# The short helps are what click makes of each command's docstring (get_short_help_str, cut at 45 characters),
+# so help reads the same before and after a module is loaded. Update them with the docstrings.
+COMMAND_GROUPS = [
+    ((), 'commands.generic', [
+        ('binary', ['b'], 'Convert binary to text'),
+        ('cointoss', [], 'Toss a coin'),
+        ('convert', [], 'Convert money from one currency to another.'),
+        ('covid', ['covid19', 'covid_19'], 'Display last available statistics for...'),
+        ('crypto', [], 'Display the current exchange rate of currency'),
+        ('disk_space', [], 'Display free disk space'),
+        ('disk_space_ex', [], 'Display free disk space'),
+        ('fortune', [], 'Like a Chinese fortune cookie, but less yummy'),
+        ('joke', [], 'Tell a joke'),
+        ('roll', [], 'Roll a dice.'),
+        ('stocks', ['stock', 'stonk'], 'Show info for a stock'),
+        ('uptime', [], 'Show uptime'),
+        ('urban_dictionary', ['ud'], 'Search in urban dictionary for the first...'),
+        ('weather', ['w'], 'Display the weather in any place.')]),
+    (('MOCK_CONFIGURATION',), 'commands.openshift.mock', [
+        ('mock', [], 'Switch openshift mock status on environment'),
+        ('check_mock', [], 'View current status of environment')]),
+    (('DOCKER_DEPLOY_CONFIGURATION',), 'commands.openshift.docker_deploy', [
+        ('deploy', [], 'Pull microservice image from source env...')]),
+    (('OPENSHIFT_ACTUATOR_REFRESH',), 'commands.openshift.refresh_actuator', [
+        ('actuator', [], None)]),
+    (('OPENSHIFT_SCALEDOWN',), 'commands.openshift.scaledown', [
+        ('scaledown', [], None)]),
+    (('OPENSHIFT_DEPLOYMENT',), 'commands.openshift.deployment', [
+        ('deployment', [], None)]),
+    (('CHEESE_DATABASE_URL',), 'commands.cheese', [
+        ('cheese', [], 'Cheese Service Agent')]),
+    (('SUBREDDIT_NAME',), 'commands.reddit', [
+        ('modqueue', [], None),
+        ('usernotes', [], 'Display usernotes of a user'),
+        ('youtube_info', [], 'Get YouTube media URL'),
+        ('add_domain_tag', [], 'Add a tag to a domain'),
+        ('add_policy', [], "Add a minor policy change done via Slack's..."),
+        ('archive', [], 'Archive all posts and comments of a user.'),
+        ('history', [], 'Return full user comment history,...'),
+        ('comment_source', [], 'Get comment source Syntax: comment_source...'),
+        ('deleted_comment_source', [], 'Return comment source even if deleted.'),
+        ('configure_enhanced_crowd_control', ['order66', 'order_66'], 'Configure the enhanced crowd control')]),
+    (('SUBREDDIT_NAME',), 'commands.reddit.nuke', [
+        ('nuke', [], None)]),
+    (('REDDIT_ALT_USER',), 'commands.reddit.bot', [
+        ('make', [], None)]),
+    (('QUESTIONNAIRE_DATABASE_URL', 'QUESTIONNAIRE_FILE'), 'commands.reddit.survey', [
+        ('survey', [], 'Get results from survey')]),
+    (('KUDOS_DATABASE_URL',), 'commands.kudos', [
+        ('kudos', [], 'Add kudos to user.')]),
+]
+
+# these reach the commands through ctx.obj, so each tenant can have its own.
+# The command modules read every other variable from the process environment.
+TENANT_VARIABLES = ('SUBREDDIT_NAME', 'REDDIT_ALT_USER')
 
-slack_client: slack.RTMClient = None
 logger: logging.Logger = None
 real_stdout: TextIO = None
 real_stderr: TextIO = None
-stdout: TextIO = None
-chat_obj: SlackWrapper = None
-reddit_session: praw.Reddit = None
-bot_reddit_session: praw.reddit.Reddit = None
-subreddit: praw.reddit.Subreddit = None
-subreddit_name: str = None
-trigger_words: list = []
-shortcut_words: dict = {}
-bot_name: str = None
-
-
-def init():
-    global chat_obj, logger, slack_client, subreddit_name, shortcut_words, bot_name, trigger_words
-    global real_stdout, real_stderr, stdout
-    global reddit_session, bot_reddit_session, subreddit
-    stdout = io.StringIO()
-    real_stdout = sys.stdout
-    real_stderr = sys.stderr
-    sys.stdout = sys.stderr = stdout
-
-    trigger_words = os.environ['BOT_NAME'].split()
-    bot_name = trigger_words[0]
-    logger.debug(f"Listening for {','.join(trigger_words)}")
-    if 'SHORTCUT_WORDS' in os.environ:
-        with open('data/' + os.environ['SHORTCUT_WORDS']) as sf:
-            shortcut_words = dict(yaml.load(sf))
-    else:
-        shortcut_words = {}
-
-    chat_obj = SlackWrapper(trigger_words[0])
-
-    slack_api_token = os.environ['SLACK_API_TOKEN']
-    subreddit_name = os.environ.get('SUBREDDIT_NAME')
-    slack_client = slack.RTMClient(
-        token=slack_api_token,
-        proxy=os.environ.get('HTTPS_PROXY'))
-    if subreddit_name:
-        base_user_agent = 'python:gr.terrasoft.reddit.slackmodbot'
-        user_agent = f'{base_user_agent}-{subreddit_name}:v0.4 (by /u/gschizas)'
-        reddit_session = praw_wrapper(user_agent=user_agent, scopes=['*'])
-        subreddit = reddit_session.subreddit(subreddit_name)
-        if 'REDDIT_ALT_USER' in os.environ:
-            alt_user = os.environ['REDDIT_ALT_USER']
-            alt_user_agent = f'{base_user_agent}-{subreddit_name}-as-{alt_user}:v0.4 (by /u/gschizas)'
-            bot_reddit_session = praw_wrapper(user_agent=alt_user_agent,
-                                              prompt=f'Visit the following URL as {alt_user}:',
-                                              scopes=['*'])
+dispatcher: Dispatcher = None
+deduplicator: EventDeduplicator = None
+tenants: list = []
+tenants_by_client: dict = {}
+_shared_reddit_sessions: dict = {}
+_shared_shortcuts: dict = {}
+_loggers: dict = {}
+command_requirements: dict = {}
+_shared_lock = threading.Lock()
+
+BASE_USER_AGENT = 'python:gr.terrasoft.reddit.slackmodbot'
+OUTBOUND_SHUTDOWN_TIMEOUT = 10
+
+TENANT_EVENTS = metrics.counter('slackbot_events_total', 'Messages, commands and errors per tenant', ('tenant', 'event'))
+COMMAND_LATENCY = metrics.histogram(
+    'slackbot_command_seconds', 'Time spent running a command', ('tenant', 'command', 'outcome'))
+
+
+def _serialize_requests(reddit):
+    """praw isn't thread-safe, and the dispatcher workers and modqueue pollers share its sessions.
+    Every praw call goes through Reddit.request, so one lock per session makes them take turns."""
+    lock = threading.RLock()
+    request = reddit.request
+
+    def locked_request(*args, **kwargs):
+        with lock:
+            return request(*args, **kwargs)
+
+    reddit.request = locked_request
+
+
+def _shared_reddit_session(user_agent, **kwargs):
+    # tenants that moderate the same subreddit as the same user share one praw session
+    with _shared_lock:
+        if user_agent not in _shared_reddit_sessions:
+            _shared_reddit_sessions[user_agent] = praw_wrapper(user_agent=user_agent, scopes=['*'], **kwargs)
+            metrics.instrument_reddit(_shared_reddit_sessions[user_agent])
+            _serialize_requests(_shared_reddit_sessions[user_agent])
+        return _shared_reddit_sessions[user_agent]
+
+
+def get_logger(name):
+    # setup_logging adds its handlers on every call, so each log name is only set up once
+    with _shared_lock:
+        if name not in _loggers:
+            _loggers[name] = setup_logging(name)
+        return _loggers[name]
+
+
+def _shared_shortcut_index(trigger_words, path):
+    key = (tuple(trigger_words), path)
+    with _shared_lock:
+        if key not in _shared_shortcuts:
+            _shared_shortcuts[key] = ShortcutIndex(trigger_words, path)
+        return _shared_shortcuts[key]
+
+
+class Tenant:
+    """One bot configuration (Slack token, trigger words, subreddit, LOG_NAME) hosted in this process.
+
+    The command tree, the worker pool, shortcut indexes and praw sessions are shared between tenants."""
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config.get('LOG_NAME', 'unknown')
+        self.logger = get_logger(self.name)
+        self.trigger_words = config['BOT_NAME'].split()
+        self.bot_name = self.trigger_words[0]
+        self.logger.debug(f"Listening for {','.join(self.trigger_words)}")
+        shortcuts_path = 'data/' + config['SHORTCUT_WORDS'] if 'SHORTCUT_WORDS' in config else None
+        self.shortcuts = _shared_shortcut_index(self.trigger_words, shortcuts_path)
+        # replies are delivered in the background, within Slack's rate limits, unless SLACK_SEND_INLINE is set
+        self.outbound = OutboundQueue(f'outbound-{self.name}') if 'SLACK_SEND_INLINE' not in config else None
+        self.chat = SlackWrapper(self.bot_name, coalesce='COALESCE_MESSAGES' in config, outbound=self.outbound,
+                                 directory_ttl=int(config.get('DIRECTORY_TTL', DEFAULT_DIRECTORY_TTL)),
+                                 directory_size=int(config.get('DIRECTORY_MAX_SIZE', DEFAULT_DIRECTORY_MAX_SIZE)))
+        self.startup_timing = {}
+        self.slack_client = None
+        self.reddit_session = None
+        self.bot_reddit_session = None
+        self.subreddit = None
+        self.modqueue_poller = None
+        self.alert_web_client = None
+        self.subreddit_name = config.get('SUBREDDIT_NAME')
+        if self.subreddit_name:
+            user_agent = f'{BASE_USER_AGENT}-{self.subreddit_name}:v0.4 (by /u/gschizas)'
+            self.reddit_session = _shared_reddit_session(user_agent)
+            self.subreddit = self.reddit_session.subreddit(self.subreddit_name)
+            if 'REDDIT_ALT_USER' in config:
+                alt_user = config['REDDIT_ALT_USER']
+                alt_user_agent = f'{BASE_USER_AGENT}-{self.subreddit_name}-as-{alt_user}:v0.4 (by /u/gschizas)'
+                self.bot_reddit_session = _shared_reddit_session(
+                    alt_user_agent, prompt=f'Visit the following URL as {alt_user}:')
+            if 'MODQUEUE_POLL_INTERVAL' in config or 'MODQUEUE_ALERT_CHANNEL' in config:
+                # the poller shares its listings with the modqueue commands, importing it loads commands.reddit
+                import modqueue_poller
+                self.modqueue_poller = modqueue_poller.ModqueuePoller(
+                    self.subreddit,
+                    alert=self.send_alert if 'MODQUEUE_ALERT_CHANNEL' in config else None,
+                    interval=float(config.get('MODQUEUE_POLL_INTERVAL', modqueue_poller.DEFAULT_POLL_INTERVAL)),
+                    resync_interval=float(
+                        config.get('MODQUEUE_RESYNC_INTERVAL', modqueue_poller.DEFAULT_RESYNC_INTERVAL)),
+                    alert_length=int(config.get('MODQUEUE_ALERT_LENGTH', modqueue_poller.DEFAULT_ALERT_LENGTH)),
+                    alert_age=float(config.get('MODQUEUE_ALERT_AGE', modqueue_poller.DEFAULT_ALERT_AGE)),
+                    logger=self.logger)
+
+    def connect(self, loop=None):
+        self.slack_client = slack.RTMClient(
+            token=self.config['SLACK_API_TOKEN'],
+            proxy=self.config.get('HTTPS_PROXY'),
+            loop=loop)
+        tenants_by_client[self.slack_client] = self
+
+    def run(self):
+        """Run the RTM connection of this tenant in the current thread, using its own event loop"""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.connect(loop)
+        self.slack_client.start()
+
+    def send_alert(self, text):
+        """Post to MODQUEUE_ALERT_CHANNEL, outside of any conversation with the bot"""
+        if self.alert_web_client is None:
+            self.alert_web_client = metrics.InstrumentedClient(
+                slack.WebClient(token=self.config['SLACK_API_TOKEN'], proxy=self.config.get('HTTPS_PROXY')), 'slack')
+        kwargs = {
+            'channel': self.config['MODQUEUE_ALERT_CHANNEL'],
+            'text': text,
+            'icon_emoji': ':robot_face:',
+            'username': self.bot_name}
+        if self.outbound is not None:
+            self.outbound.submit(PRIORITY_NORMAL, self.alert_web_client, 'chat_postMessage', kwargs)
+        else:
+            self.alert_web_client.chat_postMessage(**kwargs)
+
+    def warm_directory(self, web_client):
+        # noinspection PyBroadException
+        try:
+            self.chat.warm_directory(web_client)
+        except Exception:
+            self.logger.exception('Could not warm the Slack directory cache')
+
+    def count(self, event):
+        TENANT_EVENTS.inc(self.name, event)
+
+    def record_startup_stage(self, stage):
+        if stage in self.startup_timing:
+            return
+        self.startup_timing[stage] = time.time() - PROCESS_STARTED
+        self.logger.info(f"Startup timing: {stage} after {self.startup_timing[stage]:.2f}s "
+                         f"({', '.join(f'{k}={v:.2f}s' for k, v in self.startup_timing.items())})")
+
+
+def has_variables(config, variables):
+    return all(variable in (config if variable in TENANT_VARIABLES else os.environ) for variable in variables)
+
+
+def register_commands(tenant_configs):
+    for required_variables, module_name, module_commands in COMMAND_GROUPS:
+        if not any(has_variables(config, required_variables) for config in tenant_configs):
+            continue
+        for command_name, aliases, short_help in module_commands:
+            commands.gyrobot.add_lazy_command(module_name, command_name, aliases, short_help)
+            command_requirements[command_name] = required_variables
+
+
+def load_tenant_configs():
+    """Tenants come from the YAML list in TENANTS_FILE, each entry overriding the process environment.
+    Without TENANTS_FILE, the process environment is the only tenant."""
+    if 'TENANTS_FILE' not in os.environ:
+        return [dict(os.environ)]
+    with open(os.environ['TENANTS_FILE'], encoding='utf8') as tf:
+        return [{**os.environ, **dict(tenant_config)} for tenant_config in yaml.load(tf)]
+
+
+def init(tenant_configs):
+    global real_stdout, real_stderr, dispatcher, deduplicator, tenants
+    # the log handlers keep the streams they were created with, so the loggers must exist before
+    # stdout and stderr are routed to the commands' output
+    tenants = [Tenant(tenant_config) for tenant_config in tenant_configs]
+    real_stdout, real_stderr = install_output_capture()
+    register_commands(tenant_configs)
+    dispatcher = Dispatcher(handle_lines, int(os.environ.get('DISPATCHER_WORKERS', DEFAULT_WORKERS)))
+    logger.debug(f"Dispatching commands to {dispatcher.max_workers} workers")
+    # handle_message runs on the RTM event loop, the window is saved by a thread of its own
+    deduplicator = EventDeduplicator(int(os.environ.get('DEDUP_WINDOW', DEFAULT_DEDUP_WINDOW)),
+                                     path=os.environ.get('DEDUP_FILE'), autosave=False)
+    if deduplicator.path:
+        threading.Thread(target=save_deduplicator, name='dedup-save', daemon=True).start()
+    for tenant in tenants:
+        tenant.record_startup_stage('init')
+        if tenant.modqueue_poller is not None:
+            tenant.modqueue_poller.start()
+    register_metrics()
+    if 'METRICS_PORT' in os.environ:
+        metrics.start_http_server(int(os.environ['METRICS_PORT']), os.environ.get('METRICS_HOST', '127.0.0.1'))
+
+
+def save_deduplicator():
+    while True:
+        time.sleep(SAVE_INTERVAL)
+        if deduplicator.save_due():
+            deduplicator.save()
+
+
+def register_metrics():
+    def dispatcher_stats():
+        return {(key,): value for key, value in dispatcher.stats().items()}
+
+    def api_calls_skipped():
+        return {(tenant.name, method): count
+                for tenant in tenants
+                for method, count in list(tenant.chat.api_calls_skipped.items())}
+
+    def directory_cache_stats():
+        caches = [(tenant.name, cache_name, getattr(tenant.chat, cache_name))
+                  for tenant in tenants
+                  for cache_name in ('users', 'teams', 'channels', 'channel_members', 'channel_labels')]
+        stats = {(tenant_name, cache_name, 'size'): len(cache) for tenant_name, cache_name, cache in caches}
+        stats.update({(tenant_name, cache_name, stat): value
+                      for tenant_name, cache_name, cache in caches for stat, value in list(cache.stats.items())})
+        return stats
+
+    def modqueue_stats():
+        stats = {}
+        for tenant in tenants:
+            if tenant.modqueue_poller is not None:
+                stats[(tenant.name, 'length')] = len(tenant.modqueue_poller)
+                stats[(tenant.name, 'oldest_age_seconds')] = tenant.modqueue_poller.oldest_age()
+        return stats
+
+    def outbound_queue_length():
+        return {(tenant.name,): len(tenant.outbound) for tenant in tenants if tenant.outbound is not None}
+
+    metrics.callback('slackbot_dispatcher', 'Dispatcher queue depth, busy workers and saturation',
+                     'gauge', ('stat',), dispatcher_stats)
+    metrics.callback('slackbot_slack_api_calls_skipped_total', 'Slack API lookups not needed by a message',
+                     'counter', ('tenant', 'method'), api_calls_skipped)
+    metrics.callback('slackbot_directory_cache', 'Slack user/channel cache size, hits, misses and evictions',
+                     'gauge', ('tenant', 'cache', 'stat'), directory_cache_stats)
+    metrics.callback('slackbot_modqueue', 'Modqueue length and age of the oldest item, as last polled',
+                     'gauge', ('tenant', 'stat'), modqueue_stats)
+    metrics.callback('slackbot_outbound_queue_length', 'Slack API calls waiting to be delivered',
+                     'gauge', ('tenant',), outbound_queue_length)
 
 
 def excepthook(type_, value, tb):
-    global logger, chat_obj
+    global logger
     # noinspection PyBroadException
     try:
         logger.fatal(type_, value, tb, exc_info=True)
-        if chat_obj:
-            # noinspection PyBroadException
-            try:
-                error_text = f"```\n:::Error:::\n{value!r}```\n"
-            except Exception:
-                error_text = "???"
-            chat_obj.send_text(error_text, is_error=True)
     except Exception:
         sys.__excepthook__(type_, value, tb)
 
 
+@slack.RTMClient.run_on(event='hello')
+def handle_hello(**payload):
+    tenant = tenants_by_client[payload['rtm_client']]
+    tenant.record_startup_stage('connected')
+    # fill the user and channel caches without holding up the RTM loop (this runs again after every reconnect)
+    threading.Thread(target=tenant.warm_directory, args=(payload['web_client'],),
+                     name=f'directory-{tenant.name}', daemon=True).start()
+
+
+@slack.RTMClient.run_on(event='user_change')
+@slack.RTMClient.run_on(event='team_join')
+def handle_user_change(**payload):
+    tenants_by_client[payload['rtm_client']].chat.update_user(payload['data']['user'])
+
+
+@slack.RTMClient.run_on(event='channel_rename')
+@slack.RTMClient.run_on(event='channel_created')
+def handle_channel_change(**payload):
+    tenants_by_client[payload['rtm_client']].chat.update_channel(payload['data']['channel'])
+
+
+@slack.RTMClient.run_on(event='group_rename')
+def handle_group_change(**payload):
+    tenants_by_client[payload['rtm_client']].chat.update_channel(payload['data']['channel'], is_private=True)
+
+
+@slack.RTMClient.run_on(event='member_joined_channel')
+def handle_member_joined_channel(**payload):
+    data = payload['data']
+    tenants_by_client[payload['rtm_client']].chat.add_channel_member(data['channel'], data['user'])
+
+
 @slack.RTMClient.run_on(event='message')
 def handle_message(**payload):
-    global trigger_words, chat_obj
+    global dispatcher
     msg = payload['data']
     web_client = payload['web_client']
     rtm_client = payload['rtm_client']
+    tenant = tenants_by_client[rtm_client]
 
     if msg.get('subtype') in ('message_deleted', 'message_replied', 'file_share', 'bot_message', 'slackbot_response'):
-        logger.debug(f"Found message of subtype {msg.get('subtype')}")
+        tenant.logger.debug(f"Found message of subtype {msg.get('subtype')}")
         return
     if 'message' in msg:
         msg.update(msg['message'])
@@ -140,67 +401,83 @@ def handle_message(**payload):
     channel_id = msg['channel']
     team_id = msg.get('team', '')
     user_id = msg.get('user', '')
+    tenant.count('messages')
 
-    permalink = web_client.chat_getPermalink(channel=channel_id, message_ts=msg['ts'])
-    chat_obj.load(web_client, team_id, channel_id, user_id, msg, permalink)
-    chat_obj.preload(user_id, team_id, channel_id)
-
-    text_lines = parse_shortcuts(msg['text'])
-    for text_line in text_lines:
-        handle_line(text_line)
-
-
-def parse_shortcuts(text):
-    global shortcut_words
-    text_lines = [text]
-    typed_text = normalize_text(text).strip().lower().split()
-    if not typed_text:
-        return []
-    first_word = typed_text[0]
-    if first_word in shortcut_words:
-        replaced_words = shortcut_words[first_word]
-        if all([type(w) is str for w in replaced_words]):  # shortcut definition is a list of all strings
-            typed_text = replaced_words + typed_text[1:]
-            first_word = typed_text[0]
-            text = ' '.join(replaced_words) + ' ' + ' '.join(text.split()[1:])
-            text_lines = [text]
-        elif all([type(w) is list for w in replaced_words]) and \
-                all([all([type(ww) is str for ww in w]) for w in replaced_words]):
-            # shortcut definition is a list of lists and each of them is a list of strings
-            first_word = replaced_words[0][0]
-            text_lines = [' '.join(replaced_words_line) for replaced_words_line in replaced_words]
-        else:
-            logger.critical(f'Bad format for shortcut {first_word}')
-    if not any([first_word == trigger_word for trigger_word in trigger_words]):
-        return []
-    return text_lines
+    # every message gets its own context (the client and user/team/channel caches are shared),
+    # so that commands running in parallel reply to the right channel.
+    # Permalink and user/team/channel info are only fetched when a command asks for them.
+    message_chat = tenant.chat.context(web_client, team_id, channel_id, user_id, msg)
+
+    text_lines = parse_shortcuts(tenant, msg['text'])
+    if not text_lines:
+        message_chat.count_skipped_calls()
+        return
+    # an edited command arrives again as message_changed, with the ts of the original message
+    if deduplicator.is_duplicate(event_keys(msg, f'{tenant.name}:'), 'rtm'):
+        tenant.logger.debug(f"Ignoring command {msg['ts']} in {channel_id}, it already ran")
+        tenant.count('duplicates')
+        return
+    dispatcher.submit((tenant.name, channel_id), tenant, message_chat, text_lines)
+    tenant.logger.debug(f"Dispatcher status: {dispatcher.stats()}")
+
+
+def handle_lines(tenant, chat, text_lines):
+    token = current_log_name.set(tenant.name)
+    try:
+        for text_line in text_lines:
+            handle_line(tenant, chat, text_line)
+    finally:
+        current_log_name.reset(token)
+    tenant.record_startup_stage('first_message')
+    chat.count_skipped_calls()
+    tenant.logger.debug(f"Slack API calls skipped so far: {dict(chat.api_calls_skipped)}")
+
+
+def parse_shortcuts(tenant, text):
+    return tenant.shortcuts.match(text)
 
 
-def handle_line(text):
-    global chat_obj, trigger_words
-    logger.debug(f"Triggerred by {text}")
+def handle_line(tenant, chat, text):
+    tenant.logger.debug(f"Triggerred by {text}")
+    tenant.count('commands')
     line = ' '.join(text.split()[1:])
+    command_name = 'none'
+    outcome = 'error'
+    started = time.perf_counter()
     try:
         line = precmd(line)
         args = line.split()
+        if not args:
+            outcome = 'empty'
+            emptyline(tenant, chat)
+            return
+        command_name = commands.gyrobot.resolve_alias(args[0].lower())
+        if command_name != 'help' and command_name not in commands.gyrobot.commands:
+            command_name = 'unknown'
+        if not has_variables(tenant.config, command_requirements.get(command_name, ())):
+            # registered for another tenant
+            outcome = 'unavailable'
+            chat.send_text(f"{args[0]} is not available here", is_error=True)
+            return
         if args[0].lower() == 'help':
             args.pop(0)
             args.append('--help')
-        commands.gyrobot.main(args=args,
-                              prog_name=trigger_words[0],
-                              standalone_mode=False,
-                              obj={
-                                  'chat': chat_obj,
-                                  'logger': logger,
-                                  'stdout': real_stdout,
-                                  'stderr': real_stderr,
-                                  'subreddit': subreddit,
-                                  'reddit_session': reddit_session,
-                                  'bot_reddit_session': bot_reddit_session
-                              })
-
-        postcmd()
+        with chat.coalescing(), capture_output(lambda output: send_output(chat, output)):
+            commands.gyrobot.main(args=args,
+                                  prog_name=tenant.bot_name,
+                                  standalone_mode=False,
+                                  obj={
+                                      'chat': chat,
+                                      'logger': tenant.logger,
+                                      'stdout': real_stdout,
+                                      'stderr': real_stderr,
+                                      'subreddit': tenant.subreddit,
+                                      'reddit_session': tenant.reddit_session,
+                                      'bot_reddit_session': tenant.bot_reddit_session
+                                  })
+        outcome = 'ok'
     except Exception as e:
+        tenant.count('errors')
         if 'DEBUG' in os.environ:
             exception_full_text = ''.join(traceback.format_exception(*sys.exc_info()))
             error_text = f"```\n:::Error:::\n{exception_full_text}```\n"
@@ -208,9 +485,11 @@ def handle_line(text):
             error_text = f"```\n:::Error:::\n{e}```\n"
         # noinspection PyBroadException
         try:
-            chat_obj.send_text(error_text, is_error=True)
+            chat.send_text(error_text, is_error=True)
         except Exception as e:
-            logger.critical('Could not send exception error: ' + error_text)
+            tenant.logger.critical('Could not send exception error: ' + error_text)
+    finally:
+        COMMAND_LATENCY.observe(time.perf_counter() - started, tenant.name, command_name, outcome)
 
 
 IDENTCHARS = string.ascii_letters + string.digits + '_'
@@ -222,57 +501,81 @@ def precmd(line):
     return line[:i].lower() + line[i:]
 
 
-def postcmd():
-    global stdout
-    stdout.flush()
-    stdout.seek(0, io.SEEK_SET)
-    text = stdout.read()
-    stdout.close()
-    stdout = io.StringIO()
-    sys.stdout = sys.stderr = stdout
+def send_output(chat, text):
+    chat.send_text('```\n' + text + '```\n')
 
-    # self.pos = self.stdout.seek(0, io.SEEK_CUR)
-    if text != '':
-        chat_obj.send_text('```\n' + text.strip() + '```\n')
 
-
-def default(line):
+def default(tenant, chat, line):
     instant_answer_page = requests.get("https://api.duckduckgo.com/", params={'q': line, "format": "json"})
     instant_answer = instant_answer_page.json()
     # self._send_file(instant_answer_page.content, filename='duckduckgo.json', filetype='application/json')
     if isinstance(instant_answer["Answer"], str) and instant_answer["Answer"]:
-        chat_obj.send_text(instant_answer["Answer"])
+        chat.send_text(instant_answer["Answer"])
         if 'Image' in instant_answer:
-            chat_obj.send_text(instant_answer['Image'])
+            chat.send_text(instant_answer['Image'])
     elif instant_answer["AbstractText"]:
-        chat_obj.send_text(instant_answer["AbstractText"])
+        chat.send_text(instant_answer["AbstractText"])
         if 'Image' in instant_answer:
-            chat_obj.send_text(instant_answer['Image'])
+            chat.send_text(instant_answer['Image'])
     elif instant_answer['RelatedTopics']:
         topic = instant_answer['RelatedTopics'][0]
-        chat_obj.send_text(topic['Text'])
+        chat.send_text(topic['Text'])
         if 'Icon' in topic:
-            chat_obj.send_text(topic['Icon']['URL'])
+            chat.send_text(topic['Icon']['URL'])
     else:
-        chat_obj.send_text(
+        chat.send_text(
             f"```I don't know what to do with {line}.\nTry one of the following commands:\n```",
             is_error=True)
-        do_help('')
+        send_output(chat, help_text(tenant.bot_name))
+
 
+def emptyline(tenant, chat):
+    chat.send_text("```You need to provide a command. Try these:```\n", is_error=True)
+    send_output(chat, help_text(tenant.bot_name))
 
-def emptyline():
-    chat_obj.send_text("```You need to provide a command. Try these:```\n", is_error=True)
-    do_help('')
 
+def help_text(prog_name):
+    # the groups cache their rendered help, so this is cheap after the first call
+    help_context = click.Context(commands.gyrobot, info_name=prog_name)
+    return commands.gyrobot.get_help(help_context)
 
-def main():
-    global chat_obj, logger
-    global subreddit_name, subreddit, reddit_session, bot_reddit_session
-    global trigger_words, shortcut_words
-    logger = setup_logging(os.environ.get('LOG_NAME', 'unknown'))
+
+def stop_on_signal(signum, frame):
+    logger.info(f"Stopping on signal {signum}")
+    # unwinds the main thread through the cleanup at the end of main()
+    raise SystemExit(128 + signum)
+
+
+def main(tenant_configs=None):
+    global logger
+    logger = get_logger(os.environ.get('LOG_NAME', 'unknown'))
     sys.excepthook = excepthook
-    init()
-    slack_client.start()
+    # the RTM clients only stop on signals by themselves when one of them runs in the main thread
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    if tenant_configs is None:
+        tenant_configs = load_tenant_configs()
+    init(tenant_configs)
+    try:
+        if len(tenants) == 1:
+            tenants[0].connect()
+            tenants[0].slack_client.start()
+        else:
+            threads = [threading.Thread(target=tenant.run, name=f'rtm-{tenant.name}', daemon=True)
+                       for tenant in tenants]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        dispatcher.shutdown(wait=False)
+        for tenant in tenants:
+            if tenant.modqueue_poller is not None:
+                tenant.modqueue_poller.stop()
+        if deduplicator.path:
+            deduplicator.save()
+        for tenant in tenants:
+            if tenant.outbound is not None and not tenant.outbound.join(timeout=OUTBOUND_SHUTDOWN_TIMEOUT):
+                tenant.logger.warning(f"{len(tenant.outbound)} Slack messages were not delivered")
 
 
 if __name__ == '__main__':
@@ -1,20 +1,205 @@
+import contextvars
+import json
+import logging
 import os
 import pathlib
+import sqlite3
+import threading
+from collections.abc import MutableMapping
 from contextlib import contextmanager
 
 from bot_framework.yaml_wrapper import yaml
+from file_lock import atomic_open, locked, yaml_lock
+
+# set while a command runs for one of several tenants, falls back to the LOG_NAME environment variable
+current_log_name = contextvars.ContextVar('current_log_name', default=None)
+
+DATA_DIRECTORY = 'data'
+
+logger = logging.getLogger(__name__)
+
+_connections = threading.local()
+_migrated = set()
+
+
+def log_name():
+    return current_log_name.get() or os.environ.get('LOG_NAME', 'unknown')
+
+
+def _yaml_path(path, log_name):
+    return pathlib.Path(f'{DATA_DIRECTORY}/{path}-{log_name}.yml')
 
 
 @contextmanager
 def state_file(path):
+    """A dict that is saved when the block ends. STATE_BACKEND picks where: sqlite (default) or yaml"""
+    name = log_name()
+    if os.environ.get('STATE_BACKEND', 'sqlite') == 'yaml':
+        with _yaml_state_file(path, name) as data:
+            yield data
+    else:
+        with _sqlite_state_file(path, name) as data:
+            yield data
+
+
+def _read_yaml(data_file):
+    data = {}
+    if data_file.exists():
+        with data_file.open(mode='r', encoding='utf8') as y, yaml_lock:
+            data = dict(yaml.load(y) or {})
+    return data
+
+
+def _serialised(data):
+    """The values as JSON text, to find what a block changed (deepcopy of ruamel's commented maps is slow)"""
+    return {key: json.dumps(value, default=str) for key, value in data.items()}
+
+
+@contextmanager
+def _yaml_state_file(path, log_name):
+    data_file = _yaml_path(path, log_name)
+    with locked(data_file, exclusive=False):
+        data = _read_yaml(data_file)
+    original = _serialised(data)
+    yield data
+    changed = {key: value for key, value in data.items()
+               if key not in original or original[key] != json.dumps(value, default=str)}
+    deleted = original.keys() - data.keys()
+    if not changed and not deleted:
+        return
+    # apply this block's changes to what is in the file now, in case another worker or process wrote to it
+    with locked(data_file, exclusive=True):
+        current = _read_yaml(data_file)
+        current.update(changed)
+        for key in deleted:
+            current.pop(key, None)
+        with atomic_open(data_file) as y, yaml_lock:
+            yaml.dump(current, y)
+
+
+def _connection(log_name):
+    """One connection per thread and database file, in WAL mode so that readers don't wait for the writer"""
+    connections = getattr(_connections, 'by_log_name', None)
+    if connections is None:
+        connections = _connections.by_log_name = {}
+    if log_name not in connections:
+        connection = sqlite3.connect(f'{DATA_DIRECTORY}/state-{log_name}.sqlite3', timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS state ('
+                               'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                               'PRIMARY KEY (namespace, key))')
+            connection.execute('CREATE TABLE IF NOT EXISTS migrated (namespace TEXT PRIMARY KEY)')
+        connections[log_name] = connection
+    return connections[log_name]
+
+
+def migrate_yaml(connection, path, log_name):
+    """Copy data/<path>-<log_name>.yml into the database, the first time the namespace is used"""
+    if (log_name, path) in _migrated:
+        return
+    if connection.execute('SELECT 1 FROM migrated WHERE namespace = ?', (path,)).fetchone():
+        _migrated.add((log_name, path))
+        return
+    data_file = _yaml_path(path, log_name)
     data = {}
-    log_name = os.environ.get('LOG_NAME', 'unknown')
-    data_file = pathlib.Path(f'data/{path}-{log_name}.yml')
     if data_file.exists():
-        with data_file.open(mode='r', encoding='utf8') as y:
-            data = dict(yaml.load(y))
-            if not data:
-                data = {}
+        with locked(data_file, exclusive=False):
+            data = _read_yaml(data_file)
+    with connection:
+        # another worker or process may have migrated the namespace (and written to it) since the check above:
+        # check again holding the write lock, and never let the YAML replace a value that is already there
+        connection.execute('BEGIN IMMEDIATE')
+        migrated = connection.execute('SELECT 1 FROM migrated WHERE namespace = ?', (path,)).fetchone()
+        if not migrated:
+            connection.executemany('INSERT OR IGNORE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                                   [(path, json.dumps(key), json.dumps(value)) for key, value in data.items()])
+            connection.execute('INSERT INTO migrated (namespace) VALUES (?)', (path,))
+    _migrated.add((log_name, path))
+    if data and not migrated:
+        logger.info(f'Migrated {len(data)} entries from {data_file} to SQLite')
+
+
+class SqliteState(MutableMapping):
+    """The keys of one namespace, read from the database as they are used.
+
+    save() writes only the keys that were set, deleted or changed in place, in one transaction."""
+
+    def __init__(self, connection, namespace):
+        self._connection = connection
+        self._namespace = namespace
+        self._values = {}
+        self._loaded = {}  # key -> value as it was read, to find values that were changed in place
+        self._all_loaded = False
+        self._set = set()
+        self._deleted = set()
+
+    def _load(self, key):
+        if key in self._values or key in self._deleted or self._all_loaded:
+            return
+        row = self._connection.execute('SELECT value FROM state WHERE namespace = ? AND key = ?',
+                                       (self._namespace, json.dumps(key))).fetchone()
+        if row is not None:
+            self._values[key] = json.loads(row[0])
+            self._loaded[key] = row[0]
+
+    def _load_all(self):
+        if self._all_loaded:
+            return
+        for key_text, value_text in self._connection.execute(
+                'SELECT key, value FROM state WHERE namespace = ?', (self._namespace,)):
+            key = json.loads(key_text)
+            if key not in self._values and key not in self._deleted:
+                self._values[key] = json.loads(value_text)
+                self._loaded[key] = value_text
+        self._all_loaded = True
+
+    def __getitem__(self, key):
+        self._load(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._set.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        self._load(key)
+        del self._values[key]
+        self._set.discard(key)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        self._load_all()
+        return iter(list(self._values))
+
+    def __len__(self):
+        self._load_all()
+        return len(self._values)
+
+    def dirty_keys(self):
+        changed = {key for key, value_text in self._loaded.items()
+                   if key in self._values and json.dumps(self._values[key]) != value_text}
+        return self._set | changed
+
+    def save(self):
+        dirty = self.dirty_keys()
+        if not dirty and not self._deleted:
+            return
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                [(self._namespace, json.dumps(key), json.dumps(self._values[key])) for key in dirty])
+            self._connection.executemany(
+                'DELETE FROM state WHERE namespace = ? AND key = ?',
+                [(self._namespace, json.dumps(key)) for key in self._deleted])
+
+
+@contextmanager
+def _sqlite_state_file(path, log_name):
+    connection = _connection(log_name)
+    migrate_yaml(connection, path, log_name)
+    data = SqliteState(connection, path)
     yield data
-    with data_file.open(mode='w', encoding='utf8') as y:
-        yaml.dump(data, y)
\ No newline at end of file
+    data.save()
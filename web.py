@@ -1,61 +1,260 @@
-import base64
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
 import os
+import time
 
-from bot_framework.yaml_wrapper import yaml
-from flask import Flask, request, abort, make_response
-import requests
+import aiohttp
+from aiohttp import web
 
+import metrics
+from channel_policy import ChannelPolicy
+from chat.outbound import TokenBucket
+from dedup import EventDeduplicator, event_keys, DEFAULT_WINDOW as DEFAULT_DEDUP_WINDOW, SAVE_INTERVAL
 
-app = Flask(__name__)
-app.config['TEMPLATES_AUTO_RELOAD'] = True
-app.secret_key = base64.b64decode(os.environ['SLACK_SECRET_KEY'])
+SLACK_API_URL = 'https://slack.com/api/'
+PROTECTED_CHANNELS_FILE = 'data/protected_channels.yml'
+# Slack recommends rejecting requests signed more than five minutes ago, to prevent replays
+MAX_REQUEST_AGE = 5 * 60
+DEFAULT_WORKERS = 4
+MAX_QUEUED_EVENTS = 10000
+MAX_CONNECTIONS = 20
+# conversations.kick is a tier 3 method
+DEFAULT_KICKS_PER_MINUTE = 50
+KICK_CONCURRENCY = 4
+MAX_KICK_ATTEMPTS = 5
+KICK_REPORT_INTERVAL = 10
 
-user_cache = {}
+logger = logging.getLogger(__name__)
 
-with open('data/protected_channels.yml') as f:
-    protected_channels = yaml.load(f)
+EVENTS = metrics.counter('slackbot_web_events_total', 'Events API callbacks received', ('type', 'outcome'))
+KICKS = metrics.counter('slackbot_web_kicks_total', 'Users kicked from protected channels', ('outcome',))
 
 
-@app.route('/')
-def index():
-    return ""
+def verify_signature(signing_secret, timestamp, body, signature):
+    """https://api.slack.com/authentication/verifying-requests-from-slack"""
+    try:
+        if abs(time.time() - int(timestamp)) > MAX_REQUEST_AGE:
+            return False
+    except ValueError:
+        return False
+    base_string = b'v0:' + timestamp.encode() + b':' + body
+    expected = 'v0=' + hmac.new(signing_secret.encode(), base_string, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
 
 
-@app.route('/auth')
-def auth():
-    print(request.data)
-    pass
+async def index(request):
+    return web.Response(text='')
 
 
-@app.route('/event', methods=('GET', 'POST'))
-def event():
-    if not request.json:
-        abort(400)
+async def auth(request):
+    print(await request.read())
+    return web.Response(text='')
 
-    call_type = request.json['type']
+
+async def event(request):
+    """Check the request and acknowledge it right away; the workers deal with the event"""
+    body = await request.read()
+    signing_secret = request.app['signing_secret']
+    if signing_secret is not None and not verify_signature(
+            signing_secret,
+            request.headers.get('X-Slack-Request-Timestamp', ''),
+            body,
+            request.headers.get('X-Slack-Signature', '')):
+        EVENTS.inc('unknown', 'bad_signature')
+        raise web.HTTPUnauthorized()
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    if not payload:
+        raise web.HTTPBadRequest()
+
+    call_type = payload['type']
     if call_type == 'url_verification':
-        challenge = request.json['challenge']
-        return challenge
+        return web.Response(text=payload['challenge'])
     elif call_type == 'event_callback':
-        the_event = request.json['event']
-        event_type = the_event['type']
-        if event_type == 'member_joined_channel':
-            the_team = the_event['team']
-            the_channel = the_event['channel']
-            the_user = the_event['user']
-            if the_team in protected_channels and the_channel in protected_channels[the_team] and the_user not in protected_channels[the_team][the_channel]:
-                token = os.environ['SLACK_API_TOKEN']
-                resp = requests.post(
-                    'https://slack.com/api/conversations.kick',
+        the_event = payload['event']
+        # Slack redelivers events that weren't acknowledged in time
+        keys = event_keys(dict(the_event, event_id=payload.get('event_id')))
+        if request.app['dedup'].is_duplicate(keys, 'events_api'):
+            EVENTS.inc(the_event['type'], 'duplicate')
+            return web.Response(text='')
+        try:
+            request.app['events'].put_nowait(the_event)
+        except asyncio.QueueFull:
+            # Slack retries with the same event_id, which must not be taken for a duplicate
+            request.app['dedup'].forget(keys)
+            EVENTS.inc(the_event['type'], 'dropped')
+            raise web.HTTPServiceUnavailable()
+        EVENTS.inc(the_event['type'], 'queued')
+    return web.Response(text='')
+
+
+async def event_worker(app):
+    events = app['events']
+    while True:
+        the_event = await events.get()
+        # noinspection PyBroadException
+        try:
+            await handle_event(app, the_event)
+        except Exception:
+            logger.exception(f"Could not handle {the_event.get('type')} event")
+        finally:
+            events.task_done()
+
+
+async def handle_event(app, the_event):
+    event_type = the_event['type']
+    if event_type == 'member_joined_channel':
+        if app['policy'].should_kick(the_event['team'], the_event['channel'], the_event['user']):
+            await app['kicker'].request(the_event['channel'], the_event['user'])
+
+
+class Kicker:
+    """Kicks users out of protected channels, within the conversations.kick rate limit.
+
+    A raid shows up as a burst of joins (and Slack redelivers events), so a kick that is already waiting
+    for the same user and channel isn't queued again."""
+
+    def __init__(self, http, token, per_minute=DEFAULT_KICKS_PER_MINUTE):
+        self.http = http
+        self.token = token
+        self.bucket = TokenBucket(per_minute)
+        self.queue = asyncio.Queue()
+        self.pending = set()
+        self.handled = 0
+        self.rate = 0.0
+
+    async def request(self, channel, user):
+        if (channel, user) in self.pending:
+            KICKS.inc('merged')
+            return
+        self.pending.add((channel, user))
+        await self.queue.put((channel, user, 1))
+
+    async def run(self):
+        while True:
+            channel, user, attempt = await self.queue.get()
+            try:
+                wait = self.bucket.wait_time()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.bucket.wait_time()
+                self.bucket.take()
+                await self.kick(channel, user, attempt)
+            except Exception:
+                logger.exception(f"Could not kick {user} from {channel}")
+                KICKS.inc('error')
+                self.pending.discard((channel, user))
+            finally:
+                self.queue.task_done()
+
+    async def kick(self, channel, user, attempt):
+        with metrics.timed('slack', 'conversations_kick'):
+            async with self.http.post(
+                    SLACK_API_URL + 'conversations.kick',
                     json={
-                        'channel': the_channel,
-                        'user': the_user},
+                        'channel': channel,
+                        'user': user},
                     headers={
                         'Content-type': 'application/json',
-                        'Authorization': 'Bearer ' + token})
-                assert resp.ok
-                return make_response('', 200)
+                        'Authorization': 'Bearer ' + self.token}) as resp:
+                result = await resp.json(content_type=None)
+        if (resp.status == 429 or result.get('error') == 'ratelimited') and attempt < MAX_KICK_ATTEMPTS:
+            retry_after = float(resp.headers.get('Retry-After', 1))
+            logger.warning(f"conversations.kick is rate limited, retrying in {retry_after}s")
+            self.bucket.block_for(retry_after)
+            KICKS.inc('ratelimited')
+            await self.queue.put((channel, user, attempt + 1))
+            return
+        self.pending.discard((channel, user))
+        self.handled += 1
+        if resp.status != 200 or not result.get('ok'):
+            KICKS.inc('error')
+            logger.error(f"Could not kick {user} from {channel}: {resp.status} {result.get('error')}")
+            return
+        KICKS.inc('ok')
+
+    async def report(self):
+        while True:
+            handled = self.handled
+            await asyncio.sleep(KICK_REPORT_INTERVAL)
+            self.rate = (self.handled - handled) / KICK_REPORT_INTERVAL
+            if self.rate:
+                logger.info(f"Handled {self.rate:.1f} kicks/s, {self.queue.qsize()} waiting")
+
+
+async def save_dedup(app):
+    """Save the window of recent events now and then, in an executor so the handlers don't wait for the disk"""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(SAVE_INTERVAL)
+        if app['dedup'].save_due():
+            await loop.run_in_executor(None, app['dedup'].save)
+
+
+async def start_workers(app):
+    # one pooled HTTP client for every call to Slack
+    app['http'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS))
+    app['events'] = asyncio.Queue(MAX_QUEUED_EVENTS)
+    app['kicker'] = kicker = Kicker(app['http'], app['token'], app['kicks_per_minute'])
+    app['workers'] = [asyncio.ensure_future(event_worker(app)) for _ in range(app['worker_count'])]
+    app['workers'] += [asyncio.ensure_future(kicker.run()) for _ in range(KICK_CONCURRENCY)]
+    app['workers'].append(asyncio.ensure_future(kicker.report()))
+    app['workers'].append(asyncio.ensure_future(save_dedup(app)))
+    metrics.callback('slackbot_web_kicks_per_second', 'Kicks handled per second, over the last report interval',
+                     'gauge', (), lambda: {(): kicker.rate})
+
+
+async def stop_workers(app):
+    for worker in app['workers']:
+        worker.cancel()
+    await asyncio.gather(*app['workers'], return_exceptions=True)
+    await app['http'].close()
+    if app['dedup'].path:
+        await asyncio.get_event_loop().run_in_executor(None, app['dedup'].save)
+
+
+def dedup_path():
+    """WEB_DEDUP_FILE, or DEDUP_FILE with -web before the extension: slack_bot.py reads the same DEDUP_FILE,
+    and each process would overwrite the events saved by the other"""
+    if 'WEB_DEDUP_FILE' in os.environ:
+        return os.environ['WEB_DEDUP_FILE']
+    if 'DEDUP_FILE' not in os.environ:
+        return None
+    root, extension = os.path.splitext(os.environ['DEDUP_FILE'])
+    return f'{root}-web{extension}'
+
+
+def make_app(signing_secret=None, token=None, protected_channels=None, workers=None, kicks_per_minute=None):
+    app = web.Application()
+    app['signing_secret'] = signing_secret if signing_secret is not None else os.environ.get('SLACK_SIGNING_SECRET')
+    if app['signing_secret'] is None:
+        logger.warning('SLACK_SIGNING_SECRET is not set, requests are accepted without verification')
+    app['token'] = token if token is not None else os.environ['SLACK_API_TOKEN']
+    if protected_channels is not None:
+        app['policy'] = ChannelPolicy(protected_channels=protected_channels)
+    else:
+        app['policy'] = ChannelPolicy(os.environ.get('PROTECTED_CHANNELS_FILE', PROTECTED_CHANNELS_FILE))
+    app['kicks_per_minute'] = kicks_per_minute if kicks_per_minute is not None else \
+        int(os.environ.get('KICKS_PER_MINUTE', DEFAULT_KICKS_PER_MINUTE))
+    app['worker_count'] = workers if workers is not None else int(os.environ.get('WEB_WORKERS', DEFAULT_WORKERS))
+    app['dedup'] = EventDeduplicator(int(os.environ.get('DEDUP_WINDOW', DEFAULT_DEDUP_WINDOW)), path=dedup_path(),
+                                     autosave=False)
+    if 'METRICS_PORT' in os.environ:
+        # on its own port, like slack_bot.py, so that /event stays the only public endpoint
+        metrics.start_http_server(int(os.environ['METRICS_PORT']), os.environ.get('METRICS_HOST', '127.0.0.1'))
+    app.on_startup.append(start_workers)
+    app.on_cleanup.append(stop_workers)
+    app.router.add_get('/', index)
+    app.router.add_get('/auth', auth)
+    app.router.add_route('*', '/event', event)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(make_app(), host='0.0.0.0', port=5001)